@@ -0,0 +1,81 @@
+from argparse import ArgumentParser
+from asyncio import new_event_loop
+from json import dumps
+from tracemalloc import get_traced_memory, start, stop
+
+from discord import Guild, Intents, MemberCacheFlags
+from discord.state import ConnectionState
+
+# Compares what discord.py keeps for one large guild with the default member
+# cache and with [discord] lowMemory, by feeding it a synthetic GUILD_CREATE
+
+
+def guild_payload(members):
+    return {
+        "id": "1",
+        "name": "benchmark",
+        "member_count": members,
+        "roles": [],
+        "emojis": [],
+        "channels": [],
+        "members": [
+            {
+                "user": {
+                    "id": str(10**17 + i),
+                    "username": f"player{i}",
+                    "discriminator": "0001",
+                    "avatar": None,
+                },
+                "roles": [],
+                "joined_at": "2020-01-01T00:00:00+00:00",
+                "deaf": False,
+                "mute": False,
+            }
+            for i in range(members)
+        ],
+    }
+
+
+def measure(members, low_memory):
+    intents = Intents.default()
+    intents.members = not low_memory
+    state = ConnectionState(
+        dispatch=lambda *args: None,
+        handlers={},
+        hooks={},
+        syncer=None,
+        http=None,
+        loop=new_event_loop(),
+        intents=intents,
+        member_cache_flags=(
+            MemberCacheFlags.none()
+            if low_memory
+            else MemberCacheFlags.from_intents(intents)
+        ),
+        chunk_guilds_at_startup=not low_memory,
+    )
+    state.user = None
+    payload = guild_payload(members)
+    start()
+    guild = Guild(data=payload, state=state)
+    del payload
+    held, _ = get_traced_memory()
+    stop()
+    return {
+        "low_memory": low_memory,
+        "members": members,
+        "cached_members": len(guild.members),
+        "bytes": held,
+    }
+
+
+def main():
+    parser = ArgumentParser(description="member cache memory, default vs lowMemory")
+    parser.add_argument("--members", type=int, default=50000)
+    args = parser.parse_args()
+    for low_memory in (False, True):
+        print(dumps(measure(args.members, low_memory)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+from argparse import ArgumentParser
+from asyncio import create_task, gather, run
+from datetime import datetime, timedelta
+from json import dumps
+from os import environ, path
+from random import Random
+from statistics import quantiles
+from sys import path as sys_path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+# Replays realistic command mixes through the real handlers in bot.py, with
+# fake Discord objects and a local backend standing in for the database, and
+# prints one JSON line per scenario so runs can be diffed.
+
+sys_path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+for key, value in {
+    "token": "benchmark",
+    "botPrefix": "!",
+    "alertTime": "9",
+    "dbBackend": "memory",
+}.items():
+    environ.setdefault(key, value)
+
+import bot as app  # noqa: E402
+from executor import GuildBusy  # noqa: E402
+from metrics import metrics  # noqa: E402
+from scheduler import AlertScheduler  # noqa: E402
+from tasks import RateLimiter  # noqa: E402
+from tracker import open_tracker  # noqa: E402
+
+ITEMS = ["Potion", "Rope", "Torch", "Rations", "Arrows", "Gold", "Chalk", "Oil"]
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.name = f"player{user_id}"
+        self.mention = f"<@{user_id}>"
+
+    async def send(self, *args, **kwargs):
+        pass
+
+
+class FakeChannel:
+    def __init__(self):
+        self.sent = 0
+
+    async def send(self, *args, **kwargs):
+        self.sent += 1
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+
+class FakeMessage:
+    def __init__(self, guild, author, content, channel):
+        self.guild = guild
+        self.author = author
+        self.content = content
+        self.channel = channel
+        self.mentions = []
+
+    async def add_reaction(self, emoji):
+        pass
+
+
+class FakeContext:
+    def __init__(self, guild, author, content, channel):
+        self.guild = guild
+        self.author = author
+        self.channel = channel
+        self.message = FakeMessage(guild, author, content, channel)
+        self.invoked_subcommand = None
+
+    async def send(self, *args, **kwargs):
+        await self.channel.send(*args, **kwargs)
+
+
+def inv_add_text(rng, count):
+    pairs = ", ".join(
+        f"{rng.randint(1, 20)}:{rng.choice(ITEMS)} {rng.randint(1, 40)}"
+        for _ in range(count)
+    )
+    return f"!inv add {pairs}"
+
+
+# How to word each command's message, and which commands each scenario
+# replays in what proportion
+COMMANDS = {
+    "rsvp accept": lambda rng: "!rsvp accept",
+    "rsvp decline": lambda rng: "!rsvp decline",
+    "list": lambda rng: "!list",
+    "inv add": lambda rng: inv_add_text(rng, 25),
+    "players": lambda rng: "!players",
+}
+MIXES = {
+    "rsvp": {"rsvp accept": 1, "rsvp decline": 1},
+    "list": {"list": 1},
+    "inv_add": {"inv add": 1},
+    "players": {"players": 1},
+    "mixed": {
+        "rsvp accept": 25,
+        "rsvp decline": 15,
+        "list": 30,
+        "inv add": 15,
+        "players": 15,
+    },
+}
+
+
+def db_ops():
+    return {
+        labels["operation"]: histogram.count
+        for labels, histogram in metrics.series("dndbot_tracker_seconds")
+    }
+
+
+def hit_rate(cache, before):
+    hits = cache.hits - before[0]
+    lookups = hits + cache.misses - before[1]
+    return round(hits / lookups, 3) if lookups else None
+
+
+def summary(
+    name, backend, guilds, latencies, elapsed, ops_before, cache_before, renders_before
+):
+    after = db_ops()
+    ops = {
+        op: count - ops_before.get(op, 0)
+        for op, count in sorted(after.items())
+        if count - ops_before.get(op, 0)
+    }
+    cuts = quantiles(latencies, n=100, method="inclusive") if len(latencies) > 1 else []
+    return {
+        "scenario": name,
+        "backend": backend,
+        "guilds": guilds,
+        "ops": len(latencies),
+        "seconds": round(elapsed, 4),
+        "ops_per_sec": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "p50_ms": round(cuts[49] * 1000, 3) if cuts else None,
+        "p99_ms": round(cuts[98] * 1000, 3) if cuts else None,
+        "db_ops": ops,
+        "db_ops_per_op": round(sum(ops.values()) / len(latencies), 2),
+        "cache_hit_rate": hit_rate(app.tracker.cache, cache_before),
+        "render_hit_rate": hit_rate(app.renders, renders_before),
+    }
+
+
+async def timed(latencies, guild_id, handler, ctx):
+    # Through the guild's queue, as on_message runs commands
+    start = perf_counter()
+    try:
+        async with app.guilds.turn(guild_id):
+            await handler(ctx)
+    except GuildBusy:
+        return
+    latencies.append(perf_counter() - start)
+
+
+async def replay(name, args, backend, rng, channel):
+    commands = list(MIXES[name].items())
+    names = [command for command, _ in commands]
+    weights = [weight for _, weight in commands]
+    latencies = []
+    ops_before = db_ops()
+    cache_before = (app.tracker.cache.hits, app.tracker.cache.misses)
+    renders_before = (app.renders.hits, app.renders.misses)
+    rejected = app.guilds.rejected
+    start = perf_counter()
+    for offset in range(0, args.ops, args.concurrency):
+        batch = []
+        for _ in range(min(args.concurrency, args.ops - offset)):
+            command = rng.choices(names, weights)[0]
+            guild = FakeGuild(rng.randrange(args.guilds))
+            author = FakeUser(guild.id * 1000 + rng.randrange(args.players))
+            ctx = FakeContext(guild, author, COMMANDS[command](rng), channel)
+            handler = app.bot.get_command(command).callback
+            batch.append(timed(latencies, guild.id, handler, ctx))
+        await gather(*batch)
+    elapsed = perf_counter() - start
+    result = summary(
+        name,
+        backend,
+        args.guilds,
+        latencies,
+        elapsed,
+        ops_before,
+        cache_before,
+        renders_before,
+    )
+    result["rejected"] = app.guilds.rejected - rejected
+    return result
+
+
+async def dispatch(args, backend, channel):
+    # Every configured guild's four alerts in one week, as the scheduler
+    # would hand them to dispatch_alerts
+    latencies = []
+    deliver = app.deliver_alert
+
+    async def timed_deliver(alert):
+        start = perf_counter()
+        try:
+            return await deliver(alert)
+        finally:
+            latencies.append(perf_counter() - start)
+
+    app.deliver_alert = timed_deliver
+    scheduler = AlertScheduler(app.tracker, app.dispatch_alerts, app.alert_time)
+    ops_before = db_ops()
+    cache_before = (app.tracker.cache.hits, app.tracker.cache.misses)
+    renders_before = (app.renders.hits, app.renders.misses)
+    # The channel is shared with the command scenarios run before this one
+    sent_before = channel.sent
+    start = perf_counter()
+    await scheduler.load()
+    now = datetime.now()
+    await app.dispatch_alerts(scheduler._pop_due(now + timedelta(weeks=1)))
+    elapsed = perf_counter() - start
+    app.deliver_alert = deliver
+    result = summary(
+        "dispatch",
+        backend,
+        args.guilds,
+        latencies,
+        elapsed,
+        ops_before,
+        cache_before,
+        renders_before,
+    )
+    result["messages"] = channel.sent - sent_before
+    return result
+
+
+async def populate(args, rng):
+    tracker = app.tracker
+    for guild_id in range(args.guilds):
+        for player in range(args.players):
+            await tracker.register_player(guild_id, FakeUser(guild_id * 1000 + player))
+        first, second, session = rng.sample(range(7), 3)
+        await tracker.create_guild_config(
+            guild_id, FakeUser(guild_id * 1000), session, "19:00", 1, first, second
+        )
+
+
+async def main():
+    parser = ArgumentParser(description="replay command mixes against bot.py")
+    parser.add_argument("--backend", choices=("memory", "sqlite"), default="memory")
+    parser.add_argument("--guilds", type=int, default=2000)
+    parser.add_argument("--players", type=int, default=6)
+    parser.add_argument("--ops", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--write-behind", type=int, default=0, metavar="MS", help="as [db] writeBehind"
+    )
+    parser.add_argument(
+        "--scenarios", nargs="+", default=[*MIXES, "dispatch"], metavar="SCENARIO"
+    )
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as tmp:
+        app.tracker = open_tracker(
+            args.backend, app.tracker.cache, path=path.join(tmp, "bench.sqlite3")
+        )
+        await app.tracker.ensure_indexes()
+        if args.write_behind:
+            flusher = create_task(
+                app.tracker.enable_write_behind(args.write_behind / 1000).run()
+            )
+        # Measure the bot, not Discord: no global rate limit, and every
+        # channel and user resolves from the "gateway" cache
+        app.bt.limiter = RateLimiter(float("inf"))
+        channel = FakeChannel()
+        app.bot.get_channel = lambda channel_id: channel
+        app.bot.get_user = FakeUser
+        rng = Random(args.seed)
+        await populate(args, rng)
+        for name in args.scenarios:
+            if name == "dispatch":
+                result = await dispatch(args, args.backend, channel)
+            else:
+                result = await replay(name, args, args.backend, rng, channel)
+            print(dumps(result), flush=True)
+        if args.write_behind:
+            flusher.cancel()
+            await gather(flusher, return_exceptions=True)
+
+
+if __name__ == "__main__":
+    run(main())
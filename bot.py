@@ -1,164 +1,440 @@
-from asyncio import TimeoutError
+from asyncio import FIRST_COMPLETED, TimeoutError, create_task, sleep, wait
 from datetime import datetime
-from subprocess import check_output
+from re import escape, split
+from subprocess import CalledProcessError, check_output
+from time import monotonic
 
-from discord.ext import commands, tasks
-from discord import Embed, Intents
-from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure
+from discord.ext import commands
+from discord import Embed, File, HTTPException, Intents, MemberCacheFlags
 from tasks import BotTasks
-from helpers import adjacent_days, plist, Weekdays, Emojis
-from mongo_tracker import Tracker
-
-try:
-    import configparser
-
-    # Load config
-    bot_config = configparser.ConfigParser()
-    bot_config.read("config.ini")
-    token = bot_config["secrets"]["token"]
-    bot_prefix = bot_config["discord"]["botPrefix"]
-    db_host = bot_config["db"]["host"]
-    db_port = int(bot_config["db"]["port"])
-    db_password = bot_config["db"]["password"]
-    alert_time = int(bot_config["alerts"]["time"])
-except KeyError:
-    # Fall back to environment variables
-    from os import environ
-
-    token = environ["token"]
-    bot_prefix = environ["botPrefix"]
-    db_host = environ["dbHost"]
-    db_port = int(environ["dbPort"])
-    db_password = environ["dbPassword"]
-    alert_time = int(environ["alertTime"])
-
+from helpers import (
+    item_key,
+    plist,
+    parse_config,
+    parse_items,
+    rss_bytes,
+    AlertKinds,
+    Collections,
+    Weekdays,
+)
+from cache import MISSING, GuildStateCache, LRUCache
+from executor import GuildBusy, GuildExecutor
+from health import DatabaseUnavailable, HealthMonitor
+from metrics import metrics, serve_metrics
+from profiling import Profiler, memory_snapshot
+from tracker import Tracker, open_tracker
+from scheduler import AlertScheduler, AlertsFailed
+from settings import (
+    token,
+    bot_prefix,
+    low_memory,
+    queue_depth,
+    shard_count,
+    shard_ids,
+    db_backend,
+    db_path,
+    db_host,
+    db_port,
+    db_password,
+    db_cache_bytes,
+    db_change_streams,
+    db_health_interval,
+    db_health_timeout,
+    db_write_behind,
+    metrics_host,
+    metrics_port,
+    alert_time,
+    alert_concurrency,
+    alert_rate,
+)
 
 # Bot init
 intents = Intents.default()
-intents.members = True
 description = """A bot to assist with hearding players for D&D sessions."""
-bot = commands.Bot(command_prefix=bot_prefix, description=description, intents=intents)
+options = {"command_prefix": bot_prefix, "description": description}
+if low_memory:
+    # Commands only need their author and mentions, which come with the
+    # message, and DMs resolve users through BotTasks' bounded cache. !config
+    # waits for a reply rather than reactions, so no message cache either.
+    intents.members = False
+    options.update(
+        member_cache_flags=MemberCacheFlags.none(),
+        chunk_guilds_at_startup=False,
+        max_messages=None,
+    )
+else:
+    intents.members = True
+if shard_count:
+    # One worker process per group of shards; see supervisor.py
+    bot = commands.AutoShardedBot(
+        intents=intents, shard_count=shard_count, shard_ids=shard_ids, **options
+    )
+else:
+    bot = commands.Bot(intents=intents, **options)
 startTime = datetime.now().replace(microsecond=0)
+try:
+    git_hash = (
+        check_output(["git", "rev-parse", "--short", "HEAD"]).decode("ascii").strip()
+    )
+except (OSError, CalledProcessError):
+    git_hash = "unknown"
+
+tracker = open_tracker(
+    db_backend,
+    GuildStateCache(db_cache_bytes),
+    path=db_path,
+    host=db_host,
+    port=db_port,
+    password=db_password,
+)
+health = HealthMonitor(tracker, db_health_interval, db_health_timeout)
+if db_write_behind:
+    tracker.enable_write_behind(db_write_behind / 1000)
+
+
+def db_status() -> str:
+    if health.up is None:
+        return "Database has **not been checked** yet."
+    if not health.up:
+        return f"Database is **offline** since {health.since}."
+    latency = health.percentiles()
+    return (
+        f"Database is **online** since {health.since} "
+        f"(ping p50 {latency['p50'] * 1000:.0f} ms, "
+        f"p99 {latency['p99'] * 1000:.0f} ms; checked {health.checked})."
+    )
+
 
-dbh = MongoClient(host=db_host, port=db_port, password=db_password)
-tracker = Tracker(dbh["dnd-bot"])
+guilds = GuildExecutor(queue_depth)
+# Commands that wait on a person or the clock. They would hold up everything
+# else in the guild meanwhile, so they take a turn only for their writes.
+UNORDERED = {"config", "profile", "memsnap"}
 
 
 # Events
+@bot.event
+async def on_message(message):
+    # Each guild's commands run one at a time, in the order they arrived, so
+    # handlers making several tracker calls can't interleave
+    if message.author.bot:
+        return
+    ctx = await bot.get_context(message)
+    if ctx.command is None or ctx.guild is None or ctx.command.name in UNORDERED:
+        await bot.invoke(ctx)
+        return
+    try:
+        async with guilds.turn(ctx.guild.id):
+            await bot.invoke(ctx)
+    except GuildBusy:
+        await message.add_reaction("⏳")
+
+
 @bot.event
 async def on_ready():
-    print(f"[{startTime}] - Logged in as {bot.user.name} - {bot.user.id}")
+    shards = "" if shard_ids is None else f" on shards {shard_ids}"
+    print(f"[{startTime}] - Logged in as {bot.user.name} - {bot.user.id}{shards}")
+
+
+@bot.event
+async def on_command_error(ctx, error):
+    if isinstance(getattr(error, "original", None), DatabaseUnavailable):
+        await ctx.send("The database is unavailable right now; try again shortly.")
+        return
+    await commands.Bot.on_command_error(bot, ctx, error)
+
+
+@bot.event
+async def on_guild_join(guild):
+    config = await tracker.get_config_for_guild(guild.id)
+    if config is not None:
+        scheduler.update({"guild": guild.id, "config": config})
+
+
+@bot.event
+async def on_guild_remove(guild):
+    scheduler.remove(guild.id)
+
+
+# Command latency, from the hooks discord.py runs around every command
+@bot.before_invoke
+async def start_timer(ctx):
+    ctx.started = monotonic()
+
+
+@bot.after_invoke
+async def stop_timer(ctx):
+    metrics.observe(
+        "dndbot_command_seconds",
+        monotonic() - ctx.started,
+        command=ctx.command.qualified_name,
+        failed=str(ctx.command_failed).lower(),
+    )
+
+
+# Rendered read-only views (an embed, or an embed and page count), keyed by
+# the guild's cache generation. Every write to a guild (or invalidation from
+# another process) bumps it, so a repeated view skips both the fetch and the
+# formatting until something changes, and stale renders just age out.
+renders = LRUCache(maxsize=128 if low_memory else 1024)
+
+
+async def render(guild_id, view, build):
+    key = (guild_id, view, tracker.cache.generation(guild_id))
+    rendered = renders.get(key)
+    if rendered is MISSING:
+        rendered = await build()
+        renders.set(key, rendered)
+    return rendered
+
+
+PLAYERS_PER_PAGE = 20
+ITEMS_PER_PAGE = 20
+
+# Long lists are shown a page at a time, fetching only that page, and paged
+# through with reactions that edit the same message
+PAGE_BUTTONS = {"◀️": -1, "▶️": 1}
+PAGE_TIMEOUT = 120.0
+# The loop only keeps weak references to tasks
+paging = set()
+
+
+def page_embed(payload, page, pages, total, noun):
+    payload["footer"] = {"text": f"Page {page + 1} of {pages} · {total} {noun}"}
+    return Embed.from_dict(payload), pages
+
+
+async def paginate(ctx, view, build):
+    # build(page) returns (embed, pages). Paging carries on in the background
+    # so the command itself finishes once the first page is sent.
+    async def show(page):
+        return await render(ctx.guild.id, (*view, page), lambda: build(page))
+
+    embed, pages = await show(0)
+    message = await ctx.message.channel.send(embed=embed)
+    if pages > 1:
+        task = create_task(turn_pages(message, pages, show))
+        paging.add(task)
+        task.add_done_callback(paging.discard)
+
+
+def page_step(emoji):
+    # Clients don't always send the variation selector back
+    return PAGE_BUTTONS.get(str(emoji).rstrip("\ufe0f") + "\ufe0f")
+
+
+async def next_press(check):
+    # Reactions are read from the raw events, which don't need the message
+    # cache, and adding or removing one both count, so nobody needs their
+    # reaction cleared to press again
+    waiting = [
+        create_task(bot.wait_for(event, check=check))
+        for event in ("raw_reaction_add", "raw_reaction_remove")
+    ]
+    done, pending = await wait(
+        waiting, timeout=PAGE_TIMEOUT, return_when=FIRST_COMPLETED
+    )
+    for task in pending:
+        task.cancel()
+    return page_step(done.pop().result().emoji) if done else None
+
+
+async def turn_pages(message, pages, show):
+    def check(payload):
+        return (
+            payload.message_id == message.id
+            and payload.user_id != bot.user.id
+            and page_step(payload.emoji) is not None
+        )
+
+    page = 0
+    try:
+        for button in PAGE_BUTTONS:
+            await message.add_reaction(button)
+        while (step := await next_press(check)) is not None:
+            if 0 <= page + step < pages:
+                page += step
+                embed, pages = await show(page)
+                await message.edit(embed=embed)
+    except (HTTPException, DatabaseUnavailable) as e:
+        # The message was deleted, or Discord or the database is down
+        print(f"Paging stopped: {e!r}")
 
 
 # Commands
 @bot.command()
 async def status(ctx):
-    try:
-        dbh.admin.command("ping")
-    except ConnectionFailure:
-        db_status = "offline"
-    else:
-        db_status = "online"
-    git = check_output(["git", "rev-parse", "--short", "HEAD"]).decode("ascii").strip()
+    # Answers from the health monitor's last probe, so it never waits on the DB
     now = datetime.now().replace(microsecond=0)
+    cache = tracker.cache
     await ctx.message.channel.send(
-        f"Up for **{now - startTime}** on `{git}`. Database is **{db_status}**."
+        f"Up for **{now - startTime}** on `{git_hash}`. {db_status()}\n"
+        f"Cache: **{cache.hit_rate:.0%}** hits, {len(cache)} entries, "
+        f"{cache.bytes / 1024:.0f} KiB of {cache.max_bytes / 1024:.0f} KiB; "
+        f"rendered views **{renders.hit_rate:.0%}** hits.\n"
+        f"Queues: {len(guilds)} guilds busy, {guilds.rejected} commands turned "
+        "away.\n"
+        f"Memory: **{rss_bytes() / 2 ** 20:.0f} MiB** RSS, "
+        f"{sum(len(guild.members) for guild in bot.guilds)} members and "
+        f"{len(bot.users)} users cached"
+        f"{' (low-memory mode)' if low_memory else ''}."
     )
 
 
 @bot.command()
-async def config(ctx):
-    questions = ["session day", "first alert", "second alert"]
-    answers = [await ask_for_day(ctx, q) for q in questions]
-
-    def map_emoji_to_day_value(emoji):
-        for e in Emojis:
-            if e.value == emoji:
-                return Weekdays[e.name].value
-
-    mapped_answers = [map_emoji_to_day_value(a) for a in answers]
-    config = {
-        questions[i].replace(" ", "-", 1): mapped_answers[i]
-        for i in range(len(mapped_answers))
-    }
-    config["session-time"] = await ask_for_time(ctx)
-    tracker.create_guild_config(
-        guild_id=ctx.guild.id,
-        dm_user=ctx.author,
-        session_day=config["session-day"],
-        session_time=config["session-time"],
-        meeting_room=ctx.message.channel.id,
-        first_alert=config["first-alert"],
-        second_alert=config["second-alert"],
-    )
-    await ctx.message.channel.send("Config saved!")
+@commands.is_owner()
+async def perf(ctx, top: int = 8):
+    # Slowest commands, storage calls and Mongo commands by p99
+    lines = []
+    for name, title in (
+        ("dndbot_command_seconds", "Commands"),
+        ("dndbot_tracker_seconds", "Tracker"),
+        ("dndbot_mongo_command_seconds", "Mongo"),
+        ("dndbot_alert_dispatch_seconds", "Alert dispatch"),
+        ("dndbot_write_behind_lag_seconds", "Write-behind lag"),
+        ("dndbot_guild_queue_seconds", "Guild queue wait"),
+    ):
+        series = sorted(
+            metrics.series(name), key=lambda s: s[1].quantile(0.99), reverse=True
+        )
+        if not series:
+            continue
+        lines.append(f"**{title}**")
+        for labels, histogram in series[:top]:
+            label = " ".join(v for k, v in sorted(labels.items()) if k != "failed")
+            if labels.get("failed") == "true":
+                label += " (failed)"
+            lines.append(
+                f"`{label or name}`: {histogram.count} calls, "
+                f"p50 {histogram.quantile(0.5) * 1000:.1f} ms, "
+                f"p99 {histogram.quantile(0.99) * 1000:.1f} ms"
+            )
+    await ctx.send("\n".join(lines) or "Nothing measured yet.")
 
 
-async def ask_for_time(ctx):
-    my_message = await ctx.message.channel.send("Configure time (24h HH:MM):")
+profiler = Profiler()
 
-    def check(m):
-        return ctx.author == m.author
 
-    try:
-        response = await bot.wait_for("message", timeout=30.0, check=check)
-    except TimeoutError:
-        await ctx.message.channel.send("Fail! React faster!")
-        to_return = None
-    else:
-        to_return = response.content.strip()
-    finally:
-        await my_message.delete()
-        return to_return
+async def post_report(ctx, path, report):
+    # The full report goes up as a file; the message shows what fits
+    if len(report) > 1900:
+        report = report[:1900].rsplit("\n", 1)[0] + "\n..."
+    await ctx.send(f"```\n{report}\n```", file=File(str(path)))
+
+
+@bot.group(invoke_without_command=True)
+@commands.is_owner()
+async def profile(ctx):
+    state = "running" if profiler.running else "stopped"
+    await ctx.send(f"Profiler is {state}. Use `profile start [seconds]` or `stop`.")
+
+
+# A group's checks don't cover its subcommands under invoke_without_command
+@profile.command(name="start")
+@commands.is_owner()
+async def profile_start(ctx, seconds: float = 30):
+    if profiler.running:
+        await ctx.send("Already profiling.")
+        return
+    profiler.start()
+    started = profiler.started
+    await ctx.send(f"Profiling for up to {seconds:g}s.")
+    await sleep(seconds)
+    if profiler.running and profiler.started == started:
+        await post_report(ctx, *profiler.stop())
+
+
+@profile.command(name="stop")
+@commands.is_owner()
+async def profile_stop(ctx):
+    if not profiler.running:
+        await ctx.send("Not profiling.")
+        return
+    await post_report(ctx, *profiler.stop())
+
+
+@bot.command()
+@commands.is_owner()
+async def memsnap(ctx, seconds: float = 10, top: int = 10):
+    await ctx.send(f"Tracing allocations for {seconds:g}s.")
+    await post_report(ctx, *await memory_snapshot(seconds, top))
 
 
-async def ask_for_day(ctx, ask):
-    my_message = await ctx.message.channel.send(f"Configure: {ask}")
-    for emoji in Emojis:
-        await my_message.add_reaction(emoji.value)
+CONFIG_EXAMPLE = "sat 19:00 wed fri"
+
+
+@bot.command()
+async def config(ctx, *, answers: str = ""):
+    # Everything in one message, either after the command or as the reply to
+    # a single prompt, so the whole flow is one or two sends and one write
+    channel = ctx.message.channel
+    if not answers:
+        await channel.send(
+            "Reply with the session day, session time (24h HH:MM), first alert "
+            f"day and second alert day, e.g. `{CONFIG_EXAMPLE}`"
+        )
 
-    def check(reaction, user):
-        return user == ctx.author and any(e.value == str(reaction) for e in Emojis)
+        def check(m):
+            return m.author == ctx.author and m.channel == channel
 
+        try:
+            reply = await bot.wait_for("message", timeout=60.0, check=check)
+        except TimeoutError:
+            await channel.send("Fail! Reply faster!")
+            return
+        answers = reply.content
     try:
-        reaction, _ = await bot.wait_for("reaction_add", timeout=10.0, check=check)
-    except TimeoutError:
-        await ctx.message.channel.send("Fail! React faster!")
-        to_return = None
-    else:
-        to_return = str(reaction)
-    finally:
-        await my_message.delete()
-        return to_return
+        answers = parse_config(answers)
+    except ValueError as e:
+        await channel.send(
+            f"{e}. Nothing saved; try `{bot_prefix}config {CONFIG_EXAMPLE}`"
+        )
+        return
+    async with guilds.turn(ctx.guild.id, bounded=False):
+        saved = await tracker.create_guild_config(
+            guild_id=ctx.guild.id,
+            dm_user=ctx.author,
+            meeting_room=channel.id,
+            **answers,
+        )
+        scheduler.update(saved)
+    day = [day.name.title() for day in Weekdays]
+    await channel.send(
+        f"Config saved! Sessions {day[answers['session_day']]} at "
+        f"{answers['session_time']}, alerts {day[answers['first_alert']]} and "
+        f"{day[answers['second_alert']]}."
+    )
 
 
 @bot.command()
 async def unconfig(ctx):
-    tracker.rm_guild_config(ctx.guild.id)
+    await tracker.rm_guild_config(ctx.guild.id)
+    scheduler.remove(ctx.guild.id)
     await ctx.message.add_reaction("👋")
 
 
 @bot.command()
 async def register(ctx):
-    tracker.register_player(ctx.guild.id, ctx.author)
+    await tracker.register_player(ctx.guild.id, ctx.author)
     await ctx.message.add_reaction("✅")
 
 
 @bot.command()
 async def players(ctx):
-    players = tracker.get_players_for_guild(ctx.guild.id)
-    await ctx.message.channel.send(
-        embed=Embed().from_dict(
-            {
-                "title": "Registered Players",
-                "fields": [
-                    {"name": player["name"], "value": f"ID: {player['id']}"}
-                    for player in players
-                ],
-            }
+    async def build(page):
+        players, total = await tracker.get_players_page(
+            ctx.guild.id, page * PLAYERS_PER_PAGE, PLAYERS_PER_PAGE
         )
-    )
+        payload = {
+            "title": "Registered Players",
+            "fields": [
+                {"name": player["name"], "value": f"ID: {player['id']}"}
+                for player in players
+            ],
+        }
+        pages = max(1, -(-total // PLAYERS_PER_PAGE))
+        return page_embed(payload, page, pages, total, "players")
+
+    await paginate(ctx, ("players",), build)
 
 
 @bot.command()
@@ -177,28 +453,74 @@ async def cmds(ctx):
 
 @bot.command()
 async def reset(ctx):
-    tracker.reset(ctx.guild.id)
+    await tracker.reset(ctx.guild.id)
     await ctx.message.add_reaction("✅")
 
 
 @bot.command()
 async def skip(ctx):
-    tracker.skip(ctx.guild.id)
+    await tracker.skip(ctx.guild.id)
+    scheduler.remove(ctx.guild.id)
     await ctx.message.channel.send("Skipping this week!")
 
 
 @bot.command()
 async def list(ctx):
-    accept, decline, dream, cancel = tracker.get_all(ctx.guild.id)
+    async def build():
+        accept, decline, dream, cancel = await tracker.get_all(ctx.guild.id)
+        payload = {
+            "title": "Lists",
+            "fields": [
+                {"name": "Accepted", "value": plist(accept)},
+                {"name": "Declined", "value": plist(decline)},
+                {"name": "Dreamers", "value": plist(dream)},
+                {"name": "Cancelled", "value": plist(cancel)},
+            ],
+        }
+        return Embed.from_dict(payload)
+
+    await ctx.message.channel.send(embed=await render(ctx.guild.id, "list", build))
+
+
+@bot.command()
+async def stats(ctx):
+    member = ctx.message.mentions[0] if ctx.message.mentions else ctx.author
+    player_stats, guild_stats = await tracker.get_stats(ctx.guild.id, member)
+    player_stats = player_stats or {}
+    guild_stats = guild_stats or {}
+
+    def rate(part, whole):
+        return f"{part / whole:.0%}" if whole else "n/a"
+
+    sessions = player_stats.get("sessions", 0)
+    guild_sessions = guild_stats.get("sessions", 0)
     await ctx.message.channel.send(
         embed=Embed().from_dict(
             {
-                "title": "Lists",
+                "title": f"{member.name}'s Stats",
                 "fields": [
-                    {"name": "Accepted", "value": plist(accept)},
-                    {"name": "Declined", "value": plist(decline)},
-                    {"name": "Dreamers", "value": plist(dream)},
-                    {"name": "Cancelled", "value": plist(cancel)},
+                    {
+                        "name": "Attended",
+                        "value": f"{player_stats.get('attended', 0)} of {sessions} "
+                        f"({rate(player_stats.get('attended', 0), sessions)})",
+                    },
+                    {"name": "Declined", "value": str(player_stats.get("declined", 0))},
+                    {
+                        "name": "Streak",
+                        "value": f"{player_stats.get('streak', 0)} "
+                        f"(best {player_stats.get('best_streak', 0)})",
+                    },
+                    {
+                        "name": "Cancel votes",
+                        "value": f"{player_stats.get('cancel_votes', 0)} "
+                        f"({rate(player_stats.get('cancel_votes', 0), sessions)})",
+                    },
+                    {
+                        "name": "Group",
+                        "value": f"{guild_sessions} sessions, "
+                        f"{rate(guild_stats.get('cancelled', 0), guild_sessions)} "
+                        "cancelled",
+                    },
                 ],
             }
         )
@@ -209,59 +531,110 @@ async def list(ctx):
 @bot.group()
 async def inv(ctx):
     if ctx.invoked_subcommand is None:
-        if (
-            len(
-                (
-                    inv := tracker.get_inventory_for_player(
-                        ctx.guild.id, ctx.message.author
-                    )
-                )
-            )
-            == 0
-        ):
-            inv_message = "<< Empty >>"
-        else:
-            inv_message = "\n".join([f"{i['qty']}:{i['item']}" for i in inv])
+        author = ctx.message.author
 
-        await ctx.message.channel.send(
-            embed=Embed().from_dict(
-                {
-                    "fields": [
-                        {
-                            "name": f"__*{ctx.message.author.name}'s Inventory:*__",
-                            "value": inv_message,
-                        }
-                    ]
-                }
+        async def build(page):
+            inv, total = await tracker.get_inventory_page(
+                ctx.guild.id, author, page * ITEMS_PER_PAGE, ITEMS_PER_PAGE
             )
+            if len(inv) == 0:
+                inv_message = "<< Empty >>"
+            else:
+                inv_message = "\n".join([f"{i['qty']}:{i['item']}" for i in inv])
+            payload = {
+                "fields": [
+                    {
+                        "name": f"__*{author.name}'s Inventory:*__",
+                        # Embed field values stop at 1024 characters
+                        "value": inv_message[:1024],
+                    }
+                ]
+            }
+            pages = max(1, -(-total // ITEMS_PER_PAGE))
+            return page_embed(payload, page, pages, total, "items")
+
+        await paginate(ctx, ("inv", author.id, author.name), build)
+
+
+def subcommand_text(ctx, name):
+    # What follows the subcommand, whether a space or a newline comes after it
+    parts = split(rf"\s{escape(name)}(?:\s|$)", ctx.message.content, maxsplit=1)
+    return parts[1] if len(parts) > 1 else ""
+
+
+async def send_items_usage(ctx, name):
+    await ctx.message.channel.send(
+        f"Please use `{bot_prefix}inv {name} QTY:ITEM_NAME, QTY:ITEM_NAME, ...`."
+    )
+
+
+async def ack_items(ctx, failed, missing=()):
+    problems = []
+    if failed:
+        problems.append(
+            f"Couldn't read {', '.join(f'`{pair}`' for pair in failed)} "
+            "(use `QTY:ITEM_NAME`)."
         )
+    if missing:
+        problems.append(
+            f"Not in your inventory: {', '.join(f'`{item}`' for item in missing)}."
+        )
+    if problems:
+        await ctx.message.channel.send(" ".join(problems))
+        await ctx.message.add_reaction("⚠️")
+    else:
+        await ctx.message.add_reaction("✅")
 
 
 @inv.command(name="add")
 async def add(ctx):
-    _, _, items = ctx.message.content.split(" ", 2)
-    unpacked_items = items.split(", ")
-    for pair in unpacked_items:
-        qty, item = pair.split(":")
-        tracker.add_to_player_inventory(ctx.guild.id, ctx.author, item, qty)
-    await ctx.message.add_reaction("✅")
+    items, failed = parse_items(subcommand_text(ctx, "add"))
+    if not items and not failed:
+        await send_items_usage(ctx, "add")
+        return
+    if items:
+        await tracker.add_items_to_player_inventory(ctx.guild.id, ctx.author, items)
+    await ack_items(ctx, failed)
 
 
 @inv.command(name="remove")
 async def remove(ctx):
-    _, _, item = ctx.message.content.split(" ", 2)
-    tracker.rm_from_player_inventory(ctx.guild.id, ctx.author, item)
+    item = subcommand_text(ctx, "remove")
+    if not item_key(item):
+        await ctx.message.channel.send(
+            f"Please use `{bot_prefix}inv remove ITEM_NAME`."
+        )
+        return
+    await tracker.rm_from_player_inventory(ctx.guild.id, ctx.author, item)
     await ctx.message.add_reaction("✅")
 
 
+@inv.command(name="use")
+async def use(ctx):
+    item = subcommand_text(ctx, "use")
+    if not item_key(item):
+        # A name with no key (blank, or only $) would be an empty Mongo path
+        await ctx.message.channel.send(f"Please use `{bot_prefix}inv use ITEM_NAME`.")
+        return
+    left = await tracker.use_from_player_inventory(ctx.guild.id, ctx.author, item)
+    if left is None:
+        await ctx.message.channel.send(f"You don't have any `{item.strip()}`.")
+    else:
+        await ctx.message.channel.send(f"Used one `{item.strip()}`, {left} left.")
+
+
 @inv.command(name="update")
 async def update(ctx):
-    _, _, items = ctx.message.content.split(" ", 2)
-    unpacked_items = items.split(", ")
-    for pair in unpacked_items:
-        qty, item = pair.split(":")
-        tracker.update_player_inventory(ctx.guild.id, ctx.author, item, qty)
-    await ctx.message.add_reaction("✅")
+    items, failed = parse_items(subcommand_text(ctx, "update"))
+    if not items and not failed:
+        await send_items_usage(ctx, "update")
+        return
+    missing = []
+    if items:
+        missing = await tracker.update_player_inventory_items(
+            ctx.guild.id, ctx.author, items
+        )
+    await ack_items(ctx, failed, missing)
 
 
 # Support rsvp [accept|decline]
@@ -275,7 +648,9 @@ async def rsvp(ctx):
 
 @rsvp.command(name="accept")
 async def _accept(ctx):
-    tracker.add_attendee_for_guild(ctx.guild.id, ctx.author)
+    session = await tracker.move_user_for_guild(
+        ctx.guild.id, ctx.author, Collections.ATTENDEES
+    )
     await ctx.message.channel.send(
         embed=Embed().from_dict(
             {
@@ -286,18 +661,19 @@ async def _accept(ctx):
                     },
                     {
                         "name": "Attendees",
-                        "value": plist(tracker.get_attendees_for_guild(ctx.guild.id)),
+                        "value": plist(session[Collections.ATTENDEES]),
                     },
                 ]
             }
         )
     )
-    tracker.rm_decliner_for_guild(ctx.guild.id, ctx.author)
 
 
 @rsvp.command(name="decline")
 async def _decline(ctx):
-    tracker.add_decliner_for_guild(ctx.guild.id, ctx.author)
+    session = await tracker.move_user_for_guild(
+        ctx.guild.id, ctx.author, Collections.DECLINERS
+    )
     await ctx.message.channel.send(
         embed=Embed().from_dict(
             {
@@ -305,13 +681,12 @@ async def _decline(ctx):
                     {"name": "Declined", "value": "No problem, see you next time!"},
                     {
                         "name": "Those that have declined",
-                        "value": plist(tracker.get_decliners_for_guild(ctx.guild.id)),
+                        "value": plist(session[Collections.DECLINERS]),
                     },
                 ]
             }
         )
     )
-    tracker.rm_attendee_for_guild(ctx.guild.id, ctx.author)
 
 
 # Support vote [dream|cancel]
@@ -325,7 +700,9 @@ async def vote(ctx):
 
 @vote.command(name="dream")
 async def _dream(ctx):
-    tracker.add_dreamer_for_guild(ctx.guild.id, ctx.author)
+    session = await tracker.move_user_for_guild(
+        ctx.guild.id, ctx.author, Collections.DREAMERS
+    )
     await ctx.message.channel.send(
         embed=Embed().from_dict(
             {
@@ -336,7 +713,7 @@ async def _dream(ctx):
                     },
                     {
                         "name": "Other dreamers",
-                        "value": plist(tracker.get_dreamers_for_guild(ctx.guild.id)),
+                        "value": plist(session[Collections.DREAMERS]),
                     },
                 ]
             }
@@ -346,7 +723,9 @@ async def _dream(ctx):
 
 @vote.command(name="cancel")
 async def _cancel(ctx):
-    tracker.add_canceller_for_guild(ctx.guild.id, ctx.author)
+    session = await tracker.move_user_for_guild(
+        ctx.guild.id, ctx.author, Collections.CANCELLERS
+    )
     await ctx.message.channel.send(
         embed=Embed().from_dict(
             {
@@ -357,7 +736,7 @@ async def _cancel(ctx):
                     },
                     {
                         "name": "Others that have cancelled",
-                        "value": plist(tracker.get_cancellers_for_guild(ctx.guild.id)),
+                        "value": plist(session[Collections.CANCELLERS]),
                     },
                 ]
             }
@@ -365,28 +744,90 @@ async def _cancel(ctx):
     )
 
 
-bt = BotTasks(bot)
+bt = BotTasks(bot, alert_concurrency, alert_rate)
+
+
+async def deliver_alert(alert):
+    # In line with the guild's commands; alerts are never turned away
+    async with guilds.turn(alert.guild, bounded=False):
+        return await send_alert(alert)
+
+
+async def send_alert(alert):
+    if alert.kind == AlertKinds.FIRST:
+        return await bt.first_alert(alert.config)
+    if alert.kind == AlertKinds.SECOND:
+        return await bt.second_alert(alert.config)
+    if alert.kind == AlertKinds.SESSION:
+        return await bt.send_dm(alert.config, tracker)
+    return False
+
+
+async def dispatch_alerts(alerts):
+    with metrics.time("dndbot_alert_dispatch_seconds"):
+        reminders = [
+            alert
+            for alert in alerts
+            if alert.kind in (AlertKinds.FIRST, AlertKinds.SECOND)
+        ]
+        counts = {}
+        if reminders:
+            counts = await tracker.get_party_counts(
+                {alert.guild for alert in reminders}
+            )
+        open_reminders = [
+            alert for alert in reminders if not Tracker.is_full(counts[alert.guild])
+        ]
+        messages = open_reminders + [
+            alert for alert in alerts if alert.kind == AlertKinds.SESSION
+        ]
+        if messages:
+            before = bt.resolver.snapshot()
+            stats = await bt.fan_out(messages, deliver_alert)
+            stats.skipped += len(reminders) - len(open_reminders)
+            lookups = bt.resolver.snapshot() - before
+            now = datetime.now().replace(microsecond=0)
+            print(f"[{now}] - Alerts: {stats}")
+            print(
+                f"[{now}] - Lookups: {lookups['gateway']} gateway, "
+                f"{lookups['cache']} cached, {lookups['negative']} known missing, "
+                f"{lookups['rest']} REST"
+            )
+        resets = [alert.config for alert in alerts if alert.kind == AlertKinds.RESET]
+        if resets:
+            try:
+                async with guilds.turns(config["guild"] for config in resets):
+                    counts = await bt.reset_many(resets, tracker)
+            except Exception as e:
+                # The messages went out; only the resets need trying again
+                raise AlertsFailed(
+                    [alert for alert in alerts if alert.kind == AlertKinds.RESET]
+                ) from e
+            print(
+                f"[{datetime.now().replace(microsecond=0)}] - Reset {counts['sessions']} "
+                f"sessions across {counts['guilds']} guilds"
+            )
+
+
+scheduler = AlertScheduler(tracker, dispatch_alerts, alert_time)
 
 
-@tasks.loop(hours=1)
 async def alert_dispatcher():
     await bot.wait_until_ready()
-    if int(datetime.now().strftime("%H")) != alert_time:
-        return
-    today = datetime.now().weekday()
-    day_before, _ = adjacent_days(today)
-    for config in tracker.get_first_alert_configs(today):
-        if not tracker.is_full_group(config["guild"]):
-            await bt.first_alert(config)
-    for config in tracker.get_second_alert_configs(today):
-        if not tracker.is_full_group(config["guild"]):
-            await bt.second_alert(config)
-    for config in tracker.get_session_day_configs(today):
-        await bt.send_dm(config, tracker)
-    for config in tracker.get_session_day_configs(day_before):
-        bt.reset(config, tracker)
+    # A sharded worker only alerts the guilds its own shards can see
+    guild_ids = None if shard_ids is None else [guild.id for guild in bot.guilds]
+    await scheduler.run(guild_ids)
 
 
 if __name__ == "__main__":
-    alert_dispatcher.start()
+    bot.loop.run_until_complete(tracker.ensure_indexes())
+    bot.loop.create_task(alert_dispatcher())
+    bot.loop.create_task(health.run())
+    if tracker.write_behind is not None:
+        # Cancelled on shutdown, when it flushes what's left
+        bot.loop.create_task(tracker.write_behind.run())
+    if metrics_port:
+        bot.loop.create_task(serve_metrics(metrics_host, metrics_port))
+    if db_change_streams and db_backend == "mongo":
+        bot.loop.create_task(tracker.watch_invalidations())
     bot.run(token)
@@ -0,0 +1,157 @@
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Dict, Hashable, Optional, Set
+
+from bson import BSON
+
+# Returned by LRUCache.get on a miss, so a cached None can mean "known missing"
+MISSING = object()
+
+
+class LRUCache:
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self._peek(key) is not MISSING
+
+    def _peek(self, key: Hashable) -> Any:
+        try:
+            expires, value = self._data[key]
+        except KeyError:
+            return MISSING
+        if expires is not None and expires <= monotonic():
+            del self._data[key]
+            return MISSING
+        return value
+
+    def get(self, key: Hashable) -> Any:
+        value = self._peek(key)
+        if value is MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        self._data[key] = (None if ttl is None else monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable) -> Any:
+        _, value = self._data.pop(key, (None, MISSING))
+        return value
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class GuildStateCache:
+    # Read-through cache of per-guild documents, evicted least recently used
+    # once the estimated (BSON) size of everything held passes max_bytes.
+    # Cached values are shared with callers and must not be mutated.
+    def __init__(self, max_bytes: int = 8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._keys: Dict[int, Set[tuple]] = {}
+        self._generations: Dict[int, int] = {}
+        self._epoch = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def generation(self, guild_id: int) -> tuple:
+        return (self._epoch, self._generations.get(guild_id, 0))
+
+    def get(self, guild_id: int, key: Hashable) -> Any:
+        try:
+            _, value = self._data[(guild_id, key)]
+        except KeyError:
+            self.misses += 1
+            return MISSING
+        self.hits += 1
+        self._data.move_to_end((guild_id, key))
+        return value
+
+    def set(
+        self,
+        guild_id: int,
+        key: Hashable,
+        value: Any,
+        generation: Optional[tuple] = None,
+    ) -> None:
+        # A read that started before the last invalidation must not be stored
+        if generation is not None and generation != self.generation(guild_id):
+            return
+        self._discard((guild_id, key))
+        size = len(BSON.encode({"v": value}))
+        if size > self.max_bytes:
+            return
+        self._data[(guild_id, key)] = (size, value)
+        self._keys.setdefault(guild_id, set()).add((guild_id, key))
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            self._discard(next(iter(self._data)))
+
+    def replace(
+        self, guild_id: int, key: Hashable, value: Any, generation: tuple
+    ) -> None:
+        # Stores the result of a write, unless another write to the same guild
+        # finished while it was in flight
+        current = self.generation(guild_id)
+        self.invalidate(guild_id, key)
+        if generation == current:
+            self.set(guild_id, key, value)
+
+    def _discard(self, full_key: tuple) -> None:
+        entry = self._data.pop(full_key, None)
+        if entry is None:
+            return
+        self.bytes -= entry[0]
+        keys = self._keys[full_key[0]]
+        keys.discard(full_key)
+        if not keys:
+            del self._keys[full_key[0]]
+
+    def touch(self, guild_id: int) -> None:
+        # Marks the guild changed (for anything keyed by its generation)
+        # while keeping what's cached, for writes that haven't reached the
+        # database yet and are laid over it on read
+        self._generations[guild_id] = self._generations.get(guild_id, 0) + 1
+
+    def invalidate(self, guild_id: int, key: Optional[Hashable] = None) -> None:
+        self._generations[guild_id] = self._generations.get(guild_id, 0) + 1
+        if key is not None:
+            self._discard((guild_id, key))
+            return
+        for full_key in list(self._keys.get(guild_id, ())):
+            self._discard(full_key)
+
+    def clear(self) -> None:
+        self._epoch += 1
+        self._data.clear()
+        self._keys.clear()
+        self.bytes = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
@@ -0,0 +1,60 @@
+from asyncio import Lock
+from contextlib import AsyncExitStack, asynccontextmanager
+from time import monotonic
+from typing import AsyncIterator, Dict, Iterable
+
+from metrics import metrics
+
+
+class GuildBusy(Exception):
+    pass
+
+
+class GuildExecutor:
+    # Serializes work per guild: one job at a time for each guild, in arrival
+    # order (asyncio locks are FIFO), while different guilds run side by side.
+    # At most `depth` jobs may be running or waiting for one guild; past that
+    # turn() raises GuildBusy instead of queueing, so a spammy guild is
+    # turned away rather than holding ever more tasks and memory.
+    def __init__(self, depth: int = 10):
+        self.depth = depth
+        self.rejected = 0
+        self._locks: Dict[int, Lock] = {}
+        self._queued: Dict[int, int] = {}
+
+    def __len__(self) -> int:
+        # Guilds with work running or waiting
+        return len(self._queued)
+
+    def queued(self, guild_id: int) -> int:
+        return self._queued.get(guild_id, 0)
+
+    @asynccontextmanager
+    async def turn(self, guild_id: int, bounded: bool = True) -> AsyncIterator[None]:
+        # bounded=False is for work that must not be dropped (alerts)
+        queued = self.queued(guild_id)
+        if bounded and queued >= self.depth:
+            self.rejected += 1
+            raise GuildBusy(f"Guild {guild_id} has {queued} commands queued")
+        self._queued[guild_id] = queued + 1
+        lock = self._locks.setdefault(guild_id, Lock())
+        try:
+            start = monotonic()
+            async with lock:
+                metrics.observe("dndbot_guild_queue_seconds", monotonic() - start)
+                yield
+        finally:
+            self._queued[guild_id] -= 1
+            if not self._queued[guild_id]:
+                # Nobody else holds or waits on the lock
+                del self._queued[guild_id]
+                del self._locks[guild_id]
+
+    @asynccontextmanager
+    async def turns(self, guild_ids: Iterable[int]) -> AsyncIterator[None]:
+        # Every guild's turn at once, for batch work across guilds. Taken in
+        # id order so two batches can't each hold what the other waits for.
+        async with AsyncExitStack() as stack:
+            for guild_id in sorted(set(guild_ids)):
+                await stack.enter_async_context(self.turn(guild_id, bounded=False))
+            yield
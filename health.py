@@ -0,0 +1,106 @@
+from asyncio import TimeoutError, sleep, wait_for
+from collections import deque
+from datetime import datetime
+from statistics import quantiles
+from time import monotonic
+from typing import Deque, Dict, Optional, Tuple
+
+
+class DatabaseUnavailable(Exception):
+    pass
+
+
+class CircuitBreaker:
+    # Opens after `threshold` consecutive connection failures (or when the
+    # health monitor sees the database go down) so callers fail at once
+    # instead of each waiting out server selection. After `cooldown` seconds
+    # one call is let through to try the database again.
+    def __init__(self, threshold: int = 3, cooldown: float = 15):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened: Optional[float] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened is not None
+
+    def check(self) -> None:
+        if self.opened is None:
+            return
+        if monotonic() - self.opened < self.cooldown:
+            raise DatabaseUnavailable("The database is unavailable")
+        # Let this call try; everyone else keeps failing fast meanwhile
+        self.opened = monotonic()
+
+    def success(self) -> None:
+        self.failures = 0
+        self.opened = None
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.trip()
+
+    def trip(self) -> None:
+        self.failures = max(self.failures, self.threshold)
+        self.opened = monotonic()
+
+
+class HealthMonitor:
+    # Pings the database in the background so !status can answer from memory,
+    # and keeps the tracker's circuit breaker in step with what it sees
+    def __init__(
+        self,
+        tracker,
+        interval: float = 30,
+        timeout: float = 2,
+        samples: int = 120,
+        history: int = 20,
+    ):
+        self.tracker = tracker
+        self.interval = interval
+        self.timeout = timeout
+        self.latencies: Deque[float] = deque(maxlen=samples)
+        # (when, up) for each change of state, newest last
+        self.history: Deque[Tuple[datetime, bool]] = deque(maxlen=history)
+        self.up: Optional[bool] = None
+        self.checked: Optional[datetime] = None
+
+    async def probe(self) -> bool:
+        start = monotonic()
+        try:
+            up = await wait_for(self.tracker.ping(), self.timeout)
+        except TimeoutError:
+            up = False
+        if up:
+            self.latencies.append(monotonic() - start)
+            self.tracker.breaker.success()
+        else:
+            self.tracker.breaker.trip()
+        self.checked = datetime.now().replace(microsecond=0)
+        if up != self.up:
+            self.history.append((self.checked, up))
+            self.up = up
+        return up
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.probe()
+            except Exception as e:
+                print(f"Health probe failed: {e!r}")
+            await sleep(self.interval)
+
+    @property
+    def since(self) -> Optional[datetime]:
+        return self.history[-1][0] if self.history else None
+
+    def percentiles(self) -> Dict[str, float]:
+        # Ping latency in seconds over the recent samples
+        if not self.latencies:
+            return {}
+        if len(self.latencies) == 1:
+            return {"p50": self.latencies[0], "p99": self.latencies[0]}
+        cuts = quantiles(self.latencies, n=100, method="inclusive")
+        return {"p50": cuts[49], "p99": cuts[98]}
@@ -1,5 +1,6 @@
-from typing import List, Tuple
+from typing import Dict, List, Tuple, Union
 from enum import Enum, unique
+from os import sysconf
 
 
 @unique
@@ -11,28 +12,34 @@ class Collections(str, Enum):
     INVENTORIES = "inventories"
     CONFIG = "config"
     PLAYERS = "players"
+    SESSIONS = "sessions"
+    HISTORY = "history"
+    PLAYER_STATS = "player_stats"
+    GUILD_STATS = "guild_stats"
+
+
+@unique
+class AlertKinds(str, Enum):
+    FIRST = "first-alert"
+    SECOND = "second-alert"
+    SESSION = "session-day"
+    RESET = "reset"
 
 
 @unique
 class Weekdays(int, Enum):
     MONDAY = 0
     TUESDAY = 1
-    WENDESAY = 2
+    WEDNESDAY = 2
     THURSDAY = 3
     FRIDAY = 4
     SATURDAY = 5
     SUNDAY = 6
 
 
-@unique
-class Emojis(str, Enum):
-    MONDAY = "🇲"
-    TUESDAY = "🇹"
-    WENDESAY = "🇼"
-    THURSDAY = "🇷"
-    FRIDAY = "🇫"
-    SATURDAY = "🇸"
-    SUNDAY = "🇺"
+# One letter per day, as on the old reaction prompt (R for Thursday, U for
+# Sunday)
+DAY_LETTERS = "mtwrfsu"
 
 
 def plist(inlist: List) -> str:
@@ -42,6 +49,27 @@ def plist(inlist: List) -> str:
         return "None"
 
 
+def item_key(item: str) -> str:
+    # Inventory items are stored under their normalized name. Dots and a
+    # leading $ aren't allowed in Mongo field names.
+    return " ".join(item.lower().split()).replace(".", "\uff0e").lstrip("$")
+
+
+def parse_items(text: str) -> Tuple[List[Tuple[str, str]], List[str]]:
+    # Splits "QTY:ITEM, QTY:ITEM, ..." into (qty, item) pairs plus the
+    # chunks that couldn't be parsed
+    items, failed = [], []
+    for pair in text.split(","):
+        if not pair.strip():
+            continue
+        qty, _, item = pair.partition(":")
+        if not qty.strip().isdigit() or not item_key(item):
+            failed.append(pair.strip())
+        else:
+            items.append((qty.strip(), item.strip()))
+    return items, failed
+
+
 def adjacent_days(dotw: int) -> Tuple[int, int]:
     if dotw < 0 or dotw > 6:
         raise ValueError
@@ -49,3 +77,53 @@ def adjacent_days(dotw: int) -> Tuple[int, int]:
     before = days[(dotw - 1) % len(days)]
     after = days[(dotw + 1) % len(days)]
     return (int(before), int(after))
+
+
+def parse_day(word: str) -> int:
+    # A day's single letter or any unambiguous start of its name
+    word = word.strip().lower()
+    if len(word) == 1 and word in DAY_LETTERS:
+        return DAY_LETTERS.index(word)
+    days = [
+        day for day in Weekdays if len(word) > 1 and day.name.lower().startswith(word)
+    ]
+    if len(days) != 1:
+        raise ValueError(f"`{word}` isn't a day of the week")
+    return days[0].value
+
+
+def parse_time(text: str) -> str:
+    hours, _, minutes = text.strip().partition(":")
+    if not (hours.isdigit() and minutes.isdigit() and len(minutes) == 2):
+        raise ValueError(f"`{text}` isn't a HH:MM time")
+    if int(hours) > 23 or int(minutes) > 59:
+        raise ValueError(f"`{text}` isn't a time of day")
+    return f"{int(hours):02}:{minutes}"
+
+
+def parse_config(text: str) -> Dict[str, Union[int, str]]:
+    # "SESSION_DAY HH:MM FIRST_ALERT SECOND_ALERT", commas optional; the time
+    # may come anywhere, the days are taken in that order
+    words = text.replace(",", " ").split()
+    times = [word for word in words if ":" in word]
+    days = [word for word in words if ":" not in word]
+    if len(times) != 1 or len(days) != 3:
+        raise ValueError("Expected a session day, a time and two alert days")
+    session_day, first_alert, second_alert = (parse_day(day) for day in days)
+    return {
+        "session_day": session_day,
+        "session_time": parse_time(times[0]),
+        "first_alert": first_alert,
+        "second_alert": second_alert,
+    }
+
+
+def rss_bytes() -> int:
+    # Current resident set size where /proc has it, else the peak
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * sysconf("SC_PAGE_SIZE")
+    except OSError:
+        from resource import RUSAGE_SELF, getrusage
+
+        return getrusage(RUSAGE_SELF).ru_maxrss * 1024
@@ -0,0 +1,122 @@
+from argparse import ArgumentParser
+from asyncio import run
+from sys import exit
+
+from pymongo import DeleteOne, UpdateOne
+from helpers import Collections, item_key
+from tracker import SESSION_LISTS, open_tracker
+from settings import db_backend, db_path, db_host, db_port, db_password
+
+
+async def migrate_sessions(db, drop=False):
+    # Fold the legacy attendees/decliners/dreamers/cancellers collections
+    # into one session document per guild
+    for name in SESSION_LISTS:
+        ops = [
+            UpdateOne(
+                {"guild": doc["guild"]},
+                {"$addToSet": {name: {"$each": doc.get(name, [])}}},
+                upsert=True,
+            )
+            async for doc in db[name].find({}, {"_id": 0})
+        ]
+        if ops:
+            result = await db[Collections.SESSIONS].bulk_write(ops, ordered=False)
+            print(
+                f"{name.value}: merged {len(ops)} guilds "
+                f"({result.upserted_count} new sessions)"
+            )
+        else:
+            print(f"{name.value}: nothing to migrate")
+        if drop:
+            await db[name].drop()
+
+
+async def migrate_inventories(db):
+    # Old documents hold an "inv" array of {item, qty} with string quantities,
+    # keyed by the full player sub-document. A bot already upgraded adds
+    # "items" to whichever of a player's documents it matches first, so
+    # everything is folded into that one document rather than rebuilt.
+    inventories = db[Collections.INVENTORIES]
+    players = {}
+    async for doc in inventories.find({}):
+        players.setdefault((doc["guild"], doc["player"]["id"]), []).append(doc)
+    ops, migrated = [], 0
+    for docs in players.values():
+        if not any("inv" in doc for doc in docs):
+            continue
+        migrated += 1
+        keep, *extra = docs
+        names, totals = {}, {}
+        for doc in extra:
+            ops.append(DeleteOne({"_id": doc["_id"]}))
+            for key, entry in doc.get("items", {}).items():
+                names.setdefault(key, entry["item"])
+                totals[key] = totals.get(key, 0) + entry["qty"]
+        for doc in docs:
+            for entry in doc.get("inv", []):
+                key = item_key(entry["item"])
+                if not key:
+                    continue
+                qty = str(entry["qty"]).strip()
+                names.setdefault(key, entry["item"].strip())
+                totals[key] = totals.get(key, 0) + (int(qty) if qty.isdigit() else 1)
+        update = {"$unset": {"inv": ""}}
+        # Names the bot already wrote win over the old spellings
+        known = keep.get("items", {})
+        names = {key: name for key, name in names.items() if key not in known}
+        if names:
+            update["$set"] = {f"items.{key}.item": name for key, name in names.items()}
+        if totals:
+            update["$inc"] = {f"items.{key}.qty": qty for key, qty in totals.items()}
+        ops.append(UpdateOne({"_id": keep["_id"]}, update))
+    if ops:
+        await inventories.bulk_write(ops)
+    print(f"inventories: migrated {migrated} players")
+
+
+async def check_indexes(tracker):
+    failures = await tracker.check_indexes()
+    for name in failures:
+        print(f"Full scan: {name}")
+    if failures:
+        exit(1)
+    print("All Tracker queries use an index.")
+
+
+async def main():
+    parser = ArgumentParser(description="dnd-bot database maintenance")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sessions = sub.add_parser(
+        "migrate-sessions", help="merge the RSVP/vote collections into sessions"
+    )
+    sessions.add_argument(
+        "--drop", action="store_true", help="drop the legacy collections afterwards"
+    )
+    sub.add_parser(
+        "migrate-inventories", help="key inventories by item with numeric quantities"
+    )
+    sub.add_parser("ensure-indexes", help="create the indexes Tracker relies on")
+    sub.add_parser(
+        "check-indexes", help="explain every Tracker query and fail on a COLLSCAN"
+    )
+    args = parser.parse_args()
+
+    tracker = open_tracker(
+        db_backend, path=db_path, host=db_host, port=db_port, password=db_password
+    )
+    if args.command in ("migrate-sessions", "migrate-inventories"):
+        if db_backend != "mongo":
+            exit(f"{args.command} only applies to the mongo backend")
+        if args.command == "migrate-sessions":
+            await migrate_sessions(tracker.db, drop=args.drop)
+        else:
+            await migrate_inventories(tracker.db)
+    elif args.command == "ensure-indexes":
+        await tracker.ensure_indexes()
+    elif args.command == "check-indexes":
+        await check_indexes(tracker)
+
+
+if __name__ == "__main__":
+    run(main())
@@ -0,0 +1,201 @@
+from copy import deepcopy
+from datetime import datetime, timezone
+
+from helpers import Collections
+from tracker import SESSION_LISTS, Tracker, empty_counts, summarize_session
+
+
+class MemoryTracker(Tracker):
+    # Everything in process dictionaries: nothing survives a restart. Meant for
+    # trying the bot out and for exercising the Tracker API without a database.
+    # Loaders hand out copies, as a real backend would.
+    def __init__(self, cache=None):
+        super().__init__(cache)
+        self.sessions = {}
+        self.players = {}
+        self.inventories = {}
+        self.configs = {}
+        self.history = []
+        self.player_stats = {}
+        self.guild_stats = {}
+
+    async def ping(self):
+        return True
+
+    # Sessions
+
+    async def _load_session(self, guild_id):
+        return deepcopy(self.sessions.get(guild_id))
+
+    def _session(self, guild_id):
+        return self.sessions.setdefault(guild_id, {name: [] for name in SESSION_LISTS})
+
+    async def _add_session_user(self, guild_id, name, user):
+        users = self._session(guild_id)[name]
+        if user not in users:
+            users.append(dict(user))
+
+    async def _rm_session_user(self, guild_id, name, user):
+        session = self.sessions.get(guild_id)
+        if session is not None and user in session[name]:
+            session[name].remove(user)
+
+    async def _move_session_user(self, guild_id, user, to, away_from):
+        session = self._session(guild_id)
+        session[away_from] = [u for u in session[away_from] if u["id"] != user["id"]]
+        if user not in session[to]:
+            session[to].append(dict(user))
+        return deepcopy(session)
+
+    async def _reset_sessions(self, guild_ids):
+        ended = datetime.now(timezone.utc)
+        deleted = 0
+        for guild_id in guild_ids:
+            lists = self.sessions.pop(guild_id, None)
+            if lists is None:
+                continue
+            deleted += 1
+            record, players = summarize_session(lists, self.players.get(guild_id, []))
+            self.history.append({"guild": guild_id, "ended": ended, **record})
+            stats = self.guild_stats.setdefault(
+                guild_id,
+                {"guild": guild_id, "sessions": 0, "cancelled": 0, "attended": 0},
+            )
+            stats["sessions"] += 1
+            stats["cancelled"] += int(record["cancelled"])
+            stats["attended"] += len(record[Collections.ATTENDEES.value])
+            for player, flags in players:
+                stats = self.player_stats.setdefault(
+                    (guild_id, player["id"]),
+                    {
+                        "guild": guild_id,
+                        "sessions": 0,
+                        "attended": 0,
+                        "declined": 0,
+                        "cancel_votes": 0,
+                        "streak": 0,
+                        "best_streak": 0,
+                    },
+                )
+                stats["player"] = dict(player)
+                stats["sessions"] += 1
+                for field in ("attended", "declined", "cancel_votes"):
+                    stats[field] += int(flags[field])
+                stats["streak"] = stats["streak"] + 1 if flags["attended"] else 0
+                stats["best_streak"] = max(stats["best_streak"], stats["streak"])
+        return deleted
+
+    async def _load_stats(self, guild_id, player_id):
+        return (
+            deepcopy(self.player_stats.get((guild_id, player_id))),
+            deepcopy(self.guild_stats.get(guild_id)),
+        )
+
+    # Players
+
+    async def _load_players(self, guild_id):
+        return deepcopy(self.players.get(guild_id))
+
+    async def _load_players_page(self, guild_id, offset, limit):
+        players = self.players.get(guild_id, [])
+        return deepcopy(players[offset:][:limit]), len(players)
+
+    async def _add_player(self, guild_id, user):
+        players = self.players.setdefault(guild_id, [])
+        if user not in players:
+            players.append(dict(user))
+
+    async def _rm_player(self, guild_id, user):
+        players = self.players.get(guild_id)
+        if players is not None and user in players:
+            players.remove(user)
+
+    async def _party_counts(self, guild_ids):
+        counts = {}
+        for guild_id in guild_ids:
+            counts[guild_id] = row = empty_counts()
+            players = {p["id"] for p in self.players.get(guild_id, [])}
+            if guild_id not in self.players:
+                continue
+            session = self.sessions.get(guild_id) or self._session_lists(None)
+            row["registered"] = len(players)
+            for field, name in (
+                ("attending", Collections.ATTENDEES),
+                ("declined", Collections.DECLINERS),
+            ):
+                row[field] = len(players & {u["id"] for u in session[name]})
+            row["outstanding"] = max(
+                0, row["registered"] - row["attending"] - row["declined"]
+            )
+        return counts
+
+    # Inventories
+
+    async def _find_inventories(self, guild_id):
+        for (guild, _), inventory in list(self.inventories.items()):
+            if guild == guild_id:
+                yield deepcopy(inventory)
+
+    async def _load_items(self, guild_id, player_id):
+        inventory = self.inventories.get((guild_id, player_id))
+        return deepcopy(inventory["items"]) if inventory else {}
+
+    async def _load_items_page(self, guild_id, player_id, offset, limit):
+        inventory = self.inventories.get((guild_id, player_id))
+        items = [*inventory["items"].values()] if inventory else []
+        return deepcopy(items[offset:][:limit]), len(items)
+
+    async def _add_items(self, guild_id, user, names, totals):
+        inventory = self.inventories.setdefault(
+            (guild_id, user["id"]), {"guild": guild_id, "items": {}}
+        )
+        inventory["player"] = dict(user)
+        for key, qty in totals.items():
+            entry = inventory["items"].setdefault(key, {"qty": 0})
+            entry["item"] = names[key]
+            entry["qty"] += qty
+
+    async def _set_item_quantities(self, guild_id, player_id, quantities):
+        items = self.inventories[(guild_id, player_id)]["items"]
+        for key, qty in quantities.items():
+            if key in items:
+                items[key]["qty"] = qty
+
+    async def _use_item(self, guild_id, player_id, key, qty):
+        inventory = self.inventories.get((guild_id, player_id))
+        entry = inventory["items"].get(key) if inventory else None
+        if entry is None or entry["qty"] < qty:
+            return None
+        entry["qty"] -= qty
+        if entry["qty"] <= 0:
+            del inventory["items"][key]
+        return entry["qty"]
+
+    async def _rm_item(self, guild_id, player_id, key):
+        inventory = self.inventories.get((guild_id, player_id))
+        if inventory is not None:
+            inventory["items"].pop(key, None)
+
+    # Config
+
+    async def _load_config(self, guild_id):
+        found = self.configs.get(guild_id)
+        return deepcopy(found["config"]) if found else None
+
+    async def _save_config(self, guild_id, config):
+        self.configs[guild_id] = {"guild": guild_id, "config": deepcopy(config)}
+        return deepcopy(self.configs[guild_id])
+
+    async def _disable_alerts(self, guild_id):
+        if guild_id in self.configs:
+            self.configs[guild_id]["config"]["alerts"] = False
+
+    async def _rm_config(self, guild_id):
+        self.configs.pop(guild_id, None)
+
+    async def _find_configs(self, field=None, day_of_the_week=None, guild_ids=None):
+        guilds = list(self.configs) if guild_ids is None else guild_ids
+        for found in [self.configs[g] for g in guilds if g in self.configs]:
+            config = found["config"]
+            if config["alerts"] and (field is None or config[field] == day_of_the_week):
+                yield deepcopy(found)
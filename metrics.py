@@ -0,0 +1,163 @@
+from asyncio import start_server
+from contextlib import contextmanager
+from threading import Lock
+from time import monotonic
+from typing import Dict, Iterator, List, Tuple
+
+# Upper bounds in seconds (unless described otherwise), Prometheus style;
+# everything slower lands in +Inf
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q: float) -> float:
+        # Interpolated within the bucket holding the q-th observation, as
+        # Prometheus' histogram_quantile does
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class Metrics:
+    # Latency histograms keyed by metric name and label values. Observations
+    # may come from driver threads, hence the lock.
+    def __init__(self):
+        self._histograms: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], Histogram] = {}
+        self._help: Dict[str, str] = {}
+        self._buckets: Dict[str, Tuple[float, ...]] = {}
+        self._lock = Lock()
+
+    def describe(
+        self, name: str, text: str, buckets: Tuple[float, ...] = BUCKETS
+    ) -> None:
+        self._help[name] = text
+        self._buckets[name] = buckets
+
+    def observe(self, name: str, seconds: float, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(
+                    self._buckets.get(name, BUCKETS)
+                )
+            histogram.observe(seconds)
+
+    @contextmanager
+    def time(self, name: str, **labels: str) -> Iterator[None]:
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, monotonic() - start, **labels)
+
+    def series(self, name: str) -> List[Tuple[Dict[str, str], Histogram]]:
+        with self._lock:
+            return [
+                (dict(labels), histogram)
+                for (metric, labels), histogram in self._histograms.items()
+                if metric == name
+            ]
+
+    def render(self) -> str:
+        # Prometheus text exposition format
+        lines = []
+        with self._lock:
+            names = sorted({name for name, _ in self._histograms})
+            for name in names:
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} histogram")
+                for (metric, labels), histogram in sorted(self._histograms.items()):
+                    if metric != name:
+                        continue
+                    pairs = [f'{k}="{_escape(v)}"' for k, v in labels]
+                    cumulative = 0
+                    bounds = [str(b) for b in histogram.buckets] + ["+Inf"]
+                    for bound, count in zip(bounds, histogram.counts):
+                        cumulative += count
+                        le = ",".join(pairs + [f'le="{bound}"'])
+                        lines.append(f"{name}_bucket{{{le}}} {cumulative}")
+                    suffix = "{" + ",".join(pairs) + "}" if pairs else ""
+                    lines.append(f"{name}_sum{suffix} {histogram.sum}")
+                    lines.append(f"{name}_count{suffix} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# Shared by the bot, the tracker and the Mongo command listener
+metrics = Metrics()
+metrics.describe("dndbot_command_seconds", "Time to run a bot command")
+metrics.describe("dndbot_tracker_seconds", "Time for one Tracker storage call")
+metrics.describe("dndbot_mongo_command_seconds", "Time for one MongoDB command")
+metrics.describe("dndbot_alert_dispatch_seconds", "Time to send one batch of alerts")
+metrics.describe(
+    "dndbot_guild_queue_seconds", "Time work waited behind its guild's earlier work"
+)
+metrics.describe(
+    "dndbot_write_behind_batch",
+    "Buffered writes flushed at once",
+    (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+metrics.describe(
+    "dndbot_write_behind_lag_seconds",
+    "Time from the oldest buffered write to the end of its flush",
+)
+
+
+async def serve_metrics(host: str, port: int) -> None:
+    # Just enough HTTP for a Prometheus scraper: GET /metrics
+    async def handle(reader, writer):
+        try:
+            request = (await reader.readline()).split()
+            while (await reader.readline()).strip():
+                pass
+            if len(request) > 1 and request[1] == b"/metrics":
+                status, body = "200 OK", metrics.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(
+                f"HTTP/1.0 {status}\r\n"
+                "Content-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    try:
+        server = await start_server(handle, host, port)
+    except OSError as e:
+        # Otherwise lost with the task, and Prometheus just sees nothing
+        print(f"Couldn't serve metrics on {host}:{port}: {e!r}")
+        return
+    async with server:
+        await server.serve_forever()
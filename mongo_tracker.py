@@ -1,242 +1,478 @@
-from helpers import Collections
-
-
-class Tracker:
-    def __init__(self, db):
-        self.attendees = db[Collections.ATTENDEES]
-        self.decliners = db[Collections.DECLINERS]
-        self.cancellers = db[Collections.CANCELLERS]
-        self.dreamers = db[Collections.DREAMERS]
-        self.inventories = db[Collections.INVENTORIES]
-        self.config = db[Collections.CONFIG]
-        self.players = db[Collections.PLAYERS]
+from asyncio import gather
+from datetime import datetime, timezone
 
-    @staticmethod
-    def _get_user(user):
-        return {"name": user.name, "id": user.id}
-
-    def get_all(self, guild_id):
-        attendees = self.get_attendees_for_guild(guild_id)
-        decliners = self.get_decliners_for_guild(guild_id)
-        dreamers = self.get_dreamers_for_guild(guild_id)
-        cancellers = self.get_cancellers_for_guild(guild_id)
-        return (attendees, decliners, dreamers, cancellers)
-
-    def get_attendees_for_guild(self, guild_id):
-        try:
-            return self.attendees.find_one(
-                {"guild": guild_id}, {Collections.ATTENDEES: 1, "_id": 0}
-            )[Collections.ATTENDEES]
-        except TypeError:
-            return []
+from pymongo import ASCENDING, IndexModel, ReturnDocument, UpdateOne
+from pymongo.errors import ConnectionFailure
+from pymongo.monitoring import CommandListener
+from helpers import Collections
+from metrics import metrics
+from tracker import (
+    ALERT_FIELDS,
+    Tracker,
+    empty_counts,
+    summarize_session,
+)
+
+
+def _has_stage(plan, stage):
+    if isinstance(plan, dict):
+        if plan.get("stage") == stage:
+            return True
+        return any(_has_stage(value, stage) for value in plan.values())
+    if isinstance(plan, list):
+        return any(_has_stage(value, stage) for value in plan)
+    return False
+
+
+class CommandTimer(CommandListener):
+    # Times every command the driver sends, by command and collection
+    def __init__(self):
+        self._collections = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        self._collections[(event.connection_id, event.request_id)] = (
+            collection if isinstance(collection, str) else ""
+        )
 
-    def get_decliners_for_guild(self, guild_id):
-        try:
-            return self.decliners.find_one(
-                {"guild": guild_id}, {Collections.DECLINERS: 1, "_id": 0}
-            )[Collections.DECLINERS]
-        except TypeError:
-            return []
+    def succeeded(self, event):
+        self._record(event)
 
-    def get_cancellers_for_guild(self, guild_id):
-        try:
-            return self.cancellers.find_one(
-                {"guild": guild_id}, {Collections.CANCELLERS: 1, "_id": 0}
-            )[Collections.CANCELLERS]
-        except TypeError:
-            return []
+    def failed(self, event):
+        self._record(event)
 
-    def get_dreamers_for_guild(self, guild_id):
-        try:
-            return self.dreamers.find_one(
-                {"guild": guild_id}, {Collections.DREAMERS: 1, "_id": 0}
-            )[Collections.DREAMERS]
-        except TypeError:
-            return []
+    def _record(self, event):
+        metrics.observe(
+            "dndbot_mongo_command_seconds",
+            event.duration_micros / 1e6,
+            command=event.command_name,
+            collection=self._collections.pop(
+                (event.connection_id, event.request_id), ""
+            ),
+        )
 
-    def get_inventories_for_guild(self, guild_id):
-        return self.inventories.find({"guild": guild_id})
 
-    def get_inventory_for_player(self, guild_id, player):
-        try:
-            return self.inventories.find_one(
-                {"guild": guild_id, "player": self._get_user(player)}
-            )["inv"]
-        except TypeError:
-            return []
+class MongoTracker(Tracker):
+    unavailable_errors = (ConnectionFailure,)
 
-    def get_config_for_guild(self, guild_id):
-        try:
-            return self.config.find_one(
-                {"guild": guild_id}, {Collections.CONFIG: 1, "_id": 0}
-            )[Collections.CONFIG]
-        except TypeError:
-            return None
+    def __init__(self, db, cache=None):
+        super().__init__(cache)
+        self.db = db
+        self.sessions = db[Collections.SESSIONS]
+        self.inventories = db[Collections.INVENTORIES]
+        self.config = db[Collections.CONFIG]
+        self.players = db[Collections.PLAYERS]
+        self.history = db[Collections.HISTORY]
+        self.player_stats = db[Collections.PLAYER_STATS]
+        self.guild_stats = db[Collections.GUILD_STATS]
+
+    async def ensure_indexes(self):
+        unique_guild = IndexModel([("guild", ASCENDING)], unique=True)
+        await self.sessions.create_indexes([unique_guild])
+        await self.players.create_indexes([unique_guild])
+        await self.config.create_indexes(
+            [unique_guild]
+            + [
+                IndexModel(
+                    [(f"config.{field}", ASCENDING)],
+                    name=f"{field}_alerts",
+                    partialFilterExpression={"config.alerts": True},
+                )
+                for field in ALERT_FIELDS + ("alerts",)
+            ]
+        )
+        guild_player = IndexModel(
+            [("guild", ASCENDING), ("player.id", ASCENDING)], unique=True
+        )
+        await self.inventories.create_indexes([guild_player])
+        await self.player_stats.create_indexes([guild_player])
+        await self.guild_stats.create_indexes([unique_guild])
+        await self.history.create_indexes(
+            [IndexModel([("guild", ASCENDING), ("ended", ASCENDING)])]
+        )
 
-    def get_players_for_guild(self, guild_id):
+    def _query_shapes(self):
+        guild = {"guild": 0}
+        player = {"guild": 0, "player.id": 0}
+        shapes = [
+            ("sessions by guild", self.sessions, guild),
+            ("players by guild", self.players, guild),
+            ("config by guild", self.config, guild),
+            ("inventories by guild", self.inventories, guild),
+            ("inventory by player", self.inventories, player),
+            ("history by guild", self.history, guild),
+            ("player stats by player", self.player_stats, player),
+            ("guild stats by guild", self.guild_stats, guild),
+        ]
+        shapes.append(("config with alerts", self.config, {"config.alerts": True}))
+        shapes.append(
+            (
+                "config with alerts by guilds",
+                self.config,
+                {"config.alerts": True, "guild": {"$in": [0]}},
+            )
+        )
+        for field in ALERT_FIELDS:
+            shapes.append(
+                (
+                    f"config by {field}",
+                    self.config,
+                    {f"config.{field}": 0, "config.alerts": True},
+                )
+            )
+        return shapes
+
+    async def check_indexes(self):
+        # Returns the names of the queries the planner would answer with a COLLSCAN
+        failures = []
+        for name, collection, query in self._query_shapes():
+            plan = await collection.find(query).explain()
+            if _has_stage(plan["queryPlanner"]["winningPlan"], "COLLSCAN"):
+                failures.append(name)
+        return failures
+
+    async def ping(self):
         try:
-            return self.players.find_one(
-                {"guild": guild_id}, {Collections.PLAYERS: 1, "_id": 0}
-            )[Collections.PLAYERS]
-        except TypeError:
-            return None
-
-    def reset(self, guild_id):
-        query = {"guild": guild_id}
-        self.attendees.delete_one(query)
-        self.decliners.delete_one(query)
-        self.cancellers.delete_one(query)
-        self.dreamers.delete_one(query)
-
-    def skip(self, guild_id):
-        query = {"guild": guild_id}
-        self.db.config.update_one({query}, {"config.alerts": False})
-
-    def add_attendee_for_guild(self, guild_id, attendee):
-        return self.attendees.update_one(
-            {"guild": guild_id},
-            {"$addToSet": {"attendees": self._get_user(attendee)}},
-            upsert=True,
+            await self.db.client.admin.command("ping")
+        except ConnectionFailure:
+            return False
+        return True
+
+    async def watch_invalidations(self):
+        # Keeps the cache coherent with writes made by other bot processes.
+        # Needs a replica set; deletes carry no guild, so they clear everything.
+        pipeline = [{"$project": {"operationType": 1, "fullDocument.guild": 1}}]
+        async with self.db.watch(pipeline, full_document="updateLookup") as stream:
+            async for change in stream:
+                guild_id = (change.get("fullDocument") or {}).get("guild")
+                if guild_id is None:
+                    self.cache.clear()
+                else:
+                    self.cache.invalidate(guild_id)
+
+    def _player_query(self, guild_id, player_id):
+        return {"guild": guild_id, "player.id": player_id}
+
+    # Sessions
+
+    async def _load_session(self, guild_id):
+        return await self.sessions.find_one({"guild": guild_id}, {"_id": 0})
+
+    async def _add_session_user(self, guild_id, name, user):
+        return await self.sessions.update_one(
+            {"guild": guild_id}, {"$addToSet": {name: user}}, upsert=True
         )
 
-    def rm_attendee_for_guild(self, guild_id, attendee):
-        return self.attendees.update_one(
-            {"guild": guild_id}, {"$pull": {"attendees": self._get_user(attendee)}}
+    async def _rm_session_user(self, guild_id, name, user):
+        return await self.sessions.update_one(
+            {"guild": guild_id}, {"$pull": {name: user}}
         )
 
-    def add_decliner_for_guild(self, guild_id, decliner):
-        return self.decliners.update_one(
+    async def _move_session_user(self, guild_id, user, to, away_from):
+        return await self.sessions.find_one_and_update(
             {"guild": guild_id},
-            {"$addToSet": {"decliners": self._get_user(decliner)}},
+            {"$addToSet": {to: user}, "$pull": {away_from: {"id": user["id"]}}},
+            projection={"_id": 0},
             upsert=True,
+            return_document=ReturnDocument.AFTER,
         )
 
-    def rm_decliner_for_guild(self, guild_id, decliner):
-        return self.decliners.update_one(
-            {"guild": guild_id}, {"$pull": {"decliners": self._get_user(decliner)}}
+    async def _move_session_users(self, moves):
+        # One round trip for the whole batch. Each move is its own update, as
+        # one guild's batch can add to and pull from the same list.
+        return await self.sessions.bulk_write(
+            [
+                UpdateOne(
+                    {"guild": guild_id},
+                    {"$addToSet": {to: user}, "$pull": {away: {"id": user["id"]}}},
+                    upsert=True,
+                )
+                for guild_id, user, to, away in moves
+            ],
+            ordered=False,
         )
 
-    def add_canceller_for_guild(self, guild_id, canceller):
-        return self.cancellers.update_one(
-            {"guild": guild_id},
-            {"$addToSet": {"cancellers": self._get_user(canceller)}},
+    async def _reset_sessions(self, guild_ids):
+        await self._archive(guild_ids)
+        result = await self.sessions.delete_many({"guild": {"$in": guild_ids}})
+        return result.deleted_count
+
+    async def _archive(self, guild_ids):
+        # Records each finished session in the history and folds it into the
+        # per-player and per-guild rollups: four round trips for any number
+        # of guilds
+        sessions = self.sessions.aggregate(
+            [
+                {"$match": {"guild": {"$in": guild_ids}}},
+                {
+                    "$lookup": {
+                        "from": Collections.PLAYERS.value,
+                        "localField": "guild",
+                        "foreignField": "guild",
+                        "as": "registered",
+                    }
+                },
+            ]
+        )
+        ended = datetime.now(timezone.utc)
+        history, player_ops, guild_ops = [], [], []
+        async for session in sessions:
+            registered = [
+                player
+                for doc in session["registered"]
+                for player in doc.get(Collections.PLAYERS, [])
+            ]
+            record, players = summarize_session(
+                self._session_lists(session), registered
+            )
+            history.append({"guild": session["guild"], "ended": ended, **record})
+            guild_ops.append(
+                UpdateOne(
+                    {"guild": session["guild"]},
+                    {
+                        "$inc": {
+                            "sessions": 1,
+                            "cancelled": int(record["cancelled"]),
+                            "attended": len(record[Collections.ATTENDEES.value]),
+                        }
+                    },
+                    upsert=True,
+                )
+            )
+            for player, flags in players:
+                player_ops.append(self._player_rollup(session["guild"], player, flags))
+        if not history:
+            return
+        await self.history.insert_many(history)
+        await self.guild_stats.bulk_write(guild_ops, ordered=False)
+        await self.player_stats.bulk_write(player_ops, ordered=False)
+
+    def _player_rollup(self, guild_id, player, flags):
+        def bump(field, amount):
+            return {"$add": [{"$ifNull": [f"${field}", 0]}, amount]}
+
+        return UpdateOne(
+            self._player_query(guild_id, player["id"]),
+            [
+                {
+                    "$set": {
+                        "player": {"$literal": player},
+                        "sessions": bump("sessions", 1),
+                        "attended": bump("attended", int(flags["attended"])),
+                        "declined": bump("declined", int(flags["declined"])),
+                        "cancel_votes": bump(
+                            "cancel_votes", int(flags["cancel_votes"])
+                        ),
+                        "streak": bump("streak", 1) if flags["attended"] else 0,
+                    }
+                },
+                {
+                    "$set": {
+                        "best_streak": {
+                            "$max": [{"$ifNull": ["$best_streak", 0]}, "$streak"]
+                        }
+                    }
+                },
+            ],
             upsert=True,
         )
 
-    def rm_canceller_for_guild(self, guild_id, canceller):
-        return self.cancellers.update_one(
-            {"guild": guild_id}, {"$pull": {"cancellers": self._get_user(canceller)}}
+    async def _load_stats(self, guild_id, player_id):
+        return tuple(
+            await gather(
+                self.player_stats.find_one(
+                    self._player_query(guild_id, player_id), {"_id": 0}
+                ),
+                self.guild_stats.find_one({"guild": guild_id}, {"_id": 0}),
+            )
         )
 
-    def add_dreamer_for_guild(self, guild_id, dreamer):
-        return self.dreamers.update_one(
-            {"guild": guild_id},
-            {"$addToSet": {"dreamers": self._get_user(dreamer)}},
-            upsert=True,
-        )
+    # Players
 
-    def rm_dreamer_for_guild(self, guild_id, dreamer):
-        return self.dreamers.update_one(
-            {"guild": guild_id}, {"$pull": {"dreamers": self._get_user(dreamer)}}
+    async def _load_players(self, guild_id):
+        try:
+            return (
+                await self.players.find_one(
+                    {"guild": guild_id}, {Collections.PLAYERS: 1, "_id": 0}
+                )
+            )[Collections.PLAYERS]
+        except TypeError:
+            return None
+
+    async def _load_page(self, collection, query, array, offset, limit):
+        # Slices the array server side, so only the page crosses the wire
+        found = await collection.aggregate(
+            [
+                {"$match": query},
+                {"$project": {"_id": 0, "array": {"$ifNull": [array, []]}}},
+                {
+                    "$project": {
+                        "page": {"$slice": ["$array", offset, limit]},
+                        "total": {"$size": "$array"},
+                    }
+                },
+            ]
+        ).to_list(1)
+        if not found:
+            return [], 0
+        return found[0]["page"], found[0]["total"]
+
+    async def _load_players_page(self, guild_id, offset, limit):
+        return await self._load_page(
+            self.players, {"guild": guild_id}, "$players", offset, limit
         )
 
-    def add_player_for_guild(self, guild_id, player):
-        return self.players.update_one(
+    async def _add_player(self, guild_id, user):
+        return await self.players.update_one(
             {"guild": guild_id},
-            {"$addToSet": {"players": self._get_user(player)}},
+            {"$addToSet": {Collections.PLAYERS: user}},
             upsert=True,
         )
 
-    def rm_player_for_guild(self, guild_id, player):
-        return self.players.update_one(
-            {"guild": guild_id}, {"$pull": {"players": self._get_user(player)}}
+    async def _rm_player(self, guild_id, user):
+        return await self.players.update_one(
+            {"guild": guild_id}, {"$pull": {Collections.PLAYERS: user}}
         )
 
-    def add_to_player_inventory(self, guild_id, player, item, qty):
-        return self.inventories.update_one(
-            {"guild": guild_id, "player": self._get_user(player)},
-            {"$addToSet": {"inv": {"item": item.strip(), "qty": qty}}},
-            upsert=True,
-        )
+    async def _party_counts(self, guild_ids):
+        def ids(path):
+            return {"$setUnion": [{"$ifNull": [path, []]}, []]}
 
-    def rm_from_player_inventory(self, guild_id, player, item):
-        return self.inventories.update_one(
-            {"guild": guild_id, "player": self._get_user(player)},
-            {"$pull": {"inv": {"item": item}}},
-        )
+        def registered_in(path):
+            return {"$size": {"$setIntersection": ["$players", ids(path)]}}
 
-    def update_player_inventory(self, guild_id, player, item, qty):
-        return self.inventories.update_one(
+        counts = {guild_id: empty_counts() for guild_id in guild_ids}
+        pipeline = [
+            {"$match": {"guild": {"$in": guild_ids}}},
             {
-                "guild": guild_id,
-                "player": self._get_user(player),
-                "inv.item": item.strip(),
+                "$lookup": {
+                    "from": Collections.SESSIONS.value,
+                    "localField": "guild",
+                    "foreignField": "guild",
+                    "as": "session",
+                }
             },
-            {"$set": {"inv.$.qty": qty}},
-        )
-
-    def create_guild_config(
-        self,
-        guild_id,
-        dm_user,
-        session_day,
-        session_time,
-        meeting_room,
-        first_alert,
-        second_alert,
-    ):
-        return self.config.update_one(
-            {"guild": guild_id},
             {
-                "$set": {
-                    "guild": guild_id,
-                    "config": {
-                        "session-dm": self._get_user(dm_user),
-                        "session-day": session_day,
-                        "session-time": str(session_time),
-                        "meeting-room": meeting_room,
-                        "first-alert": first_alert,
-                        "second-alert": second_alert,
-                        "alerts": True,
-                    },
+                "$project": {
+                    "_id": 0,
+                    "guild": 1,
+                    "players": ids("$players.id"),
+                    "session": {"$arrayElemAt": ["$session", 0]},
                 }
             },
-            upsert=True,
-        )
+            {
+                "$project": {
+                    "guild": 1,
+                    "registered": {"$size": "$players"},
+                    "attending": registered_in("$session.attendees.id"),
+                    "declined": registered_in("$session.decliners.id"),
+                }
+            },
+        ]
+        async for row in self.players.aggregate(pipeline):
+            row["outstanding"] = max(
+                0, row["registered"] - row["attending"] - row["declined"]
+            )
+            counts[row.pop("guild")] = row
+        return counts
+
+    # Inventories
 
-    def rm_guild_config(self, guild_id):
-        query = {"guild": guild_id}
-        return self.config.delete_one(query)
+    def _find_inventories(self, guild_id):
+        return self.inventories.find({"guild": guild_id})
+
+    async def _load_items(self, guild_id, player_id):
+        found = await self.inventories.find_one(
+            self._player_query(guild_id, player_id), {"items": 1, "_id": 0}
+        )
+        return (found or {}).get("items", {})
+
+    async def _load_items_page(self, guild_id, player_id, offset, limit):
+        # Items are keyed by name; their values in stored order make the list
+        items = {"$map": {"input": {"$objectToArray": "$items"}, "in": "$$this.v"}}
+        return await self._load_page(
+            self.inventories,
+            self._player_query(guild_id, player_id),
+            items,
+            offset,
+            limit,
+        )
 
-    def get_first_alert_configs(self, day_of_the_week: int):
-        return self.config.find(
-            {"config.first-alert": day_of_the_week, "config.alerts": True}
+    async def _add_items(self, guild_id, user, names, totals):
+        return await self.inventories.update_one(
+            self._player_query(guild_id, user["id"]),
+            {
+                "$set": {
+                    "player": user,
+                    **{f"items.{key}.item": name for key, name in names.items()},
+                },
+                "$inc": {f"items.{key}.qty": qty for key, qty in totals.items()},
+            },
+            upsert=True,
         )
 
-    def get_second_alert_configs(self, day_of_the_week: int):
-        return self.config.find(
-            {"config.second-alert": day_of_the_week, "config.alerts": True}
+    async def _set_item_quantities(self, guild_id, player_id, quantities):
+        return await self.inventories.update_one(
+            self._player_query(guild_id, player_id),
+            {"$set": {f"items.{key}.qty": qty for key, qty in quantities.items()}},
         )
 
-    def get_session_day_configs(self, day_of_the_week: int):
-        return self.config.find(
-            {"config.session-day": day_of_the_week, "config.alerts": True}
+    async def _use_item(self, guild_id, player_id, key, qty):
+        path = f"items.{key}"
+        query = self._player_query(guild_id, player_id)
+        found = await self.inventories.find_one_and_update(
+            {**query, f"{path}.qty": {"$gte": qty}},
+            {"$inc": {f"{path}.qty": -qty}},
+            projection={path: 1, "_id": 0},
+            return_document=ReturnDocument.AFTER,
         )
+        if found is None:
+            return None
+        left = found["items"][key]["qty"]
+        if left <= 0:
+            await self.inventories.update_one(
+                {**query, f"{path}.qty": {"$lte": 0}}, {"$unset": {path: ""}}
+            )
+        return left
+
+    async def _rm_item(self, guild_id, player_id, key):
+        return await self.inventories.update_one(
+            self._player_query(guild_id, player_id), {"$unset": {f"items.{key}": ""}}
+        )
+
+    # Config
+
+    async def _load_config(self, guild_id):
+        try:
+            return (
+                await self.config.find_one(
+                    {"guild": guild_id}, {Collections.CONFIG: 1, "_id": 0}
+                )
+            )[Collections.CONFIG]
+        except TypeError:
+            return None
 
-    def register_player(self, guild_id: int, player):
-        return self.players.update_one(
+    async def _save_config(self, guild_id, config):
+        return await self.config.find_one_and_update(
             {"guild": guild_id},
-            {"$addToSet": {Collections.PLAYERS: self._get_user(player)}},
+            {"$set": {"guild": guild_id, "config": config}},
+            projection={"_id": 0},
             upsert=True,
+            return_document=ReturnDocument.AFTER,
         )
 
-    def unregister_player(self, guild_id: int, player):
-        return self.players.update_one(
-            {"guild": guild_id},
-            {"$pull": {Collections.PLAYERS: self._get_user(player)}},
+    async def _disable_alerts(self, guild_id):
+        return await self.config.update_one(
+            {"guild": guild_id}, {"$set": {"config.alerts": False}}
         )
 
-    def is_full_group(self, guild_id: int) -> bool:
-        players = [player["id"] for player in self.get_players_for_guild(guild_id)]
-        attendees = [att["id"] for att in self.get_attendees_for_guild(guild_id)]
-        return len(players) == len(attendees)
+    async def _rm_config(self, guild_id):
+        return await self.config.delete_one({"guild": guild_id})
+
+    def _find_configs(self, field=None, day_of_the_week=None, guild_ids=None):
+        query = {"config.alerts": True}
+        if field is not None:
+            query[f"config.{field}"] = day_of_the_week
+        if guild_ids is not None:
+            query["guild"] = {"$in": list(guild_ids)}
+        return self.config.find(query)
@@ -0,0 +1,86 @@
+import tracemalloc
+from asyncio import sleep
+from cProfile import Profile
+from datetime import datetime
+from pathlib import Path
+from pstats import Stats
+from typing import Optional, Tuple
+
+PROFILE_DIR = Path("profiles")
+# Overlapping memory snapshots share one tracemalloc session: the last one to
+# finish stops it, unless something else was tracing before the first began
+_snapshots = 0
+_started_tracing = False
+
+
+def _stamp() -> str:
+    return datetime.now().strftime("%Y%m%d-%H%M%S")
+
+
+class Profiler:
+    # cProfile around the event loop thread, on only between start and stop
+    def __init__(self, directory: Path = PROFILE_DIR):
+        self.directory = directory
+        self.profile: Optional[Profile] = None
+        self.started: Optional[datetime] = None
+
+    @property
+    def running(self) -> bool:
+        return self.profile is not None
+
+    def start(self) -> None:
+        self.profile = Profile()
+        self.started = datetime.now()
+        self.profile.enable()
+
+    def stop(self, top: int = 15) -> Tuple[Path, str]:
+        # Writes the raw stats (for snakeviz/pstats) and returns the hottest
+        # functions by cumulative time
+        profile, self.profile = self.profile, None
+        profile.disable()
+        elapsed = (datetime.now() - self.started).total_seconds()
+        self.directory.mkdir(exist_ok=True)
+        path = self.directory / f"profile-{_stamp()}.pstats"
+        profile.dump_stats(str(path))
+        rows = sorted(
+            Stats(profile).stats.items(), key=lambda row: row[1][3], reverse=True
+        )
+        lines = [f"{elapsed:.1f}s profiled", "   cumtime    tottime    calls  function"]
+        for (filename, line, function), (_, calls, total, cumulative, _) in rows[:top]:
+            where = f"{Path(filename).name}:{line}({function})"
+            lines.append(f"{cumulative:9.3f}s {total:9.3f}s {calls:8}  {where}")
+        return path, "\n".join(lines)
+
+
+async def memory_snapshot(
+    seconds: float, top: int = 10, directory: Path = PROFILE_DIR
+) -> Tuple[Path, str]:
+    # Traces allocations only for the window, then reports which lines grew
+    # the most and which hold the most of what was allocated meanwhile
+    global _snapshots, _started_tracing
+    if not _snapshots:
+        _started_tracing = not tracemalloc.is_tracing()
+        if _started_tracing:
+            tracemalloc.start()
+    _snapshots += 1
+    try:
+        before = tracemalloc.take_snapshot()
+        await sleep(seconds)
+        after = tracemalloc.take_snapshot()
+    finally:
+        _snapshots -= 1
+        if not _snapshots and _started_tracing:
+            tracemalloc.stop()
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    before, after = before.filter_traces(ignore), after.filter_traces(ignore)
+    growth = after.compare_to(before, "lineno")[:top]
+    held = after.statistics("lineno")[:top]
+    lines = [f"Growth over {seconds:g}s:"]
+    lines += [f"{stat.size_diff / 1024:+9.1f} KiB  {stat.traceback}" for stat in growth]
+    lines += ["", "Largest allocations:"]
+    lines += [f"{stat.size / 1024:9.1f} KiB  {stat.traceback}" for stat in held]
+    report = "\n".join(lines)
+    directory.mkdir(exist_ok=True)
+    path = directory / f"memsnap-{_stamp()}.txt"
+    path.write_text(report + "\n")
+    return path, report
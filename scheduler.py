@@ -0,0 +1,184 @@
+from asyncio import Event, TimeoutError, sleep, wait_for
+from datetime import datetime, timedelta
+from heapq import heappop, heappush
+from itertools import count
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+from helpers import AlertKinds, adjacent_days, parse_time
+
+
+class Alert(NamedTuple):
+    when: datetime
+    guild: int
+    kind: AlertKinds
+    config: dict
+
+
+# Alerts due at the same moment fire in this order
+KIND_ORDER = {kind: i for i, kind in enumerate(AlertKinds)}
+# A failed batch is tried again after RETRY_DELAY seconds, until its alerts
+# are more than RETRY_WINDOW late
+RETRY_DELAY = 60
+RETRY_WINDOW = timedelta(hours=1)
+
+
+class AlertsFailed(Exception):
+    # Raised by a handler that got part way: only these alerts are retried
+    def __init__(self, alerts: List[Alert]):
+        super().__init__(f"{len(alerts)} alerts failed")
+        self.alerts = alerts
+
+
+class AlertScheduler:
+    def __init__(
+        self,
+        tracker,
+        handler: Callable[[List[Alert]], Awaitable[None]],
+        alert_hour: int,
+    ):
+        self.tracker = tracker
+        self.handler = handler
+        self.alert_hour = alert_hour
+        self._queue: List[tuple] = []
+        self._generations: Dict[int, int] = {}
+        self._seq = count()
+        self._changed = Event()
+
+    def _weekday_for(self, config, kind: AlertKinds) -> Optional[int]:
+        if kind == AlertKinds.RESET:
+            session_day = config["config"]["session-day"]
+            return None if session_day is None else adjacent_days(session_day)[1]
+        return config["config"][kind.value]
+
+    def _time_for(self, config, kind: AlertKinds) -> Tuple[int, int]:
+        # RSVP reminders go out at the global alert hour. The DM's confirm
+        # list goes then too, or at the session's start if that's earlier,
+        # and the reset a day after the session started. A missing or
+        # unreadable session-time falls back to the alert hour.
+        default = (self.alert_hour, 0)
+        if kind in (AlertKinds.FIRST, AlertKinds.SECOND):
+            return default
+        try:
+            session_time = parse_time(config["config"].get("session-time") or "")
+        except ValueError:
+            return default
+        hours, minutes = (int(part) for part in session_time.split(":"))
+        if kind == AlertKinds.SESSION:
+            return min(default, (hours, minutes))
+        return hours, minutes
+
+    def _next_fire(
+        self, weekday: int, at: Tuple[int, int], after: datetime
+    ) -> datetime:
+        fire = after.replace(hour=at[0], minute=at[1], second=0, microsecond=0)
+        fire += timedelta(days=(weekday - after.weekday()) % 7)
+        if fire <= after:
+            fire += timedelta(weeks=1)
+        return fire
+
+    def _push(
+        self, alert: Alert, at: Optional[datetime] = None, repeat: bool = True
+    ) -> None:
+        # `at` defers a retry without changing when the alert was meant for;
+        # retries don't repeat, next week's alert is already queued
+        heappush(
+            self._queue,
+            (
+                at or alert.when,
+                KIND_ORDER[alert.kind],
+                next(self._seq),
+                self._generations[alert.guild],
+                repeat,
+                alert,
+            ),
+        )
+
+    def update(self, config, now: Optional[datetime] = None) -> None:
+        # Replaces every pending alert for the guild; older entries go stale
+        guild = config["guild"]
+        self._generations[guild] = self._generations.get(guild, 0) + 1
+        if not config["config"].get("alerts", True):
+            self._changed.set()
+            return
+        now = now or datetime.now()
+        for kind in AlertKinds:
+            weekday = self._weekday_for(config, kind)
+            if weekday is None:
+                continue
+            at = self._time_for(config, kind)
+            self._push(Alert(self._next_fire(weekday, at, now), guild, kind, config))
+        self._changed.set()
+
+    def remove(self, guild_id: int) -> None:
+        self._generations[guild_id] = self._generations.get(guild_id, 0) + 1
+        self._changed.set()
+
+    def _pop_due(self, now: datetime) -> List[Alert]:
+        due = []
+        while self._queue and self._queue[0][0] <= now:
+            *_, generation, repeat, alert = heappop(self._queue)
+            if generation != self._generations.get(alert.guild):
+                continue
+            due.append(alert)
+            if not repeat:
+                continue
+            weekday = self._weekday_for(alert.config, alert.kind)
+            at = self._time_for(alert.config, alert.kind)
+            self._push(alert._replace(when=self._next_fire(weekday, at, alert.when)))
+        return due
+
+    def _retry(self, alerts: List[Alert], now: datetime) -> None:
+        at = now + timedelta(seconds=RETRY_DELAY)
+        for alert in alerts:
+            if at - alert.when > RETRY_WINDOW:
+                print(f"Giving up on {alert.kind.value} alert for {alert.guild}")
+                continue
+            self._push(alert, at, repeat=False)
+
+    async def load(self, guild_ids: Optional[Iterable[int]] = None) -> None:
+        now = datetime.now()
+        async for config in self.tracker.get_alert_configs(guild_ids):
+            self.update(config, now)
+
+    async def run(self, guild_ids: Optional[Iterable[int]] = None) -> None:
+        # guild_ids limits a sharded worker to the guilds on its own shards
+        guild_ids = None if guild_ids is None else list(guild_ids)
+        while True:
+            # Same as a failed dispatch: without the configs nothing would
+            # ever be scheduled, so keep trying rather than end the task
+            try:
+                await self.load(guild_ids)
+                break
+            except Exception as e:
+                print(f"Loading alert configs failed: {e!r}")
+                await sleep(RETRY_DELAY)
+        while True:
+            self._changed.clear()
+            now = datetime.now()
+            due = self._pop_due(now)
+            if due:
+                # A failure (e.g. the database being down) must not end the
+                # loop, or no guild would get another alert until a restart
+                try:
+                    await self.handler(due)
+                except AlertsFailed as e:
+                    print(f"Alert dispatch failed: {(e.__cause__ or e)!r}")
+                    self._retry(e.alerts, now)
+                except Exception as e:
+                    print(f"Alert dispatch failed: {e!r}")
+                    self._retry(due, now)
+                continue
+            timeout = (self._queue[0][0] - now).total_seconds() if self._queue else None
+            try:
+                await wait_for(self._changed.wait(), timeout)
+            except TimeoutError:
+                pass
@@ -0,0 +1,62 @@
+from os import environ
+
+try:
+    import configparser
+
+    # Load config
+    bot_config = configparser.ConfigParser()
+    bot_config.read("config.ini")
+    token = bot_config["secrets"]["token"]
+    bot_prefix = bot_config["discord"]["botPrefix"]
+    shard_count = int(bot_config["discord"].get("shardCount") or 0)
+    workers = int(bot_config["discord"].get("workers") or 1)
+    low_memory = bot_config["discord"].getboolean("lowMemory", False)
+    queue_depth = int(bot_config["discord"].get("queueDepth") or 10)
+    db_backend = bot_config["db"].get("backend", "mongo")
+    db_path = bot_config["db"].get("path", "dnd-bot.sqlite3")
+    db_host = bot_config["db"].get("host", "localhost")
+    db_port = int(bot_config["db"].get("port") or 27017)
+    db_password = bot_config["db"].get("password")
+    db_cache_bytes = int(bot_config["db"].get("cacheBytes", str(8 * 1024 * 1024)))
+    db_change_streams = bot_config["db"].getboolean("changeStreams", False)
+    db_health_interval = float(bot_config["db"].get("healthInterval", "30"))
+    db_health_timeout = float(bot_config["db"].get("healthTimeout", "2"))
+    db_write_behind = int(bot_config["db"].get("writeBehind") or 0)
+    alert_time = int(bot_config["alerts"]["time"])
+    alert_concurrency = int(bot_config["alerts"].get("concurrency", "10"))
+    alert_rate = float(bot_config["alerts"].get("rate", "40"))
+    metrics_host = bot_config.get("metrics", "host", fallback="127.0.0.1")
+    metrics_port = bot_config.getint("metrics", "port", fallback=0)
+except KeyError:
+    # Fall back to environment variables
+    token = environ["token"]
+    bot_prefix = environ["botPrefix"]
+    shard_count = int(environ.get("shardCount") or 0)
+    workers = int(environ.get("workers") or 1)
+    low_memory = environ.get("lowMemory", "false").lower() == "true"
+    queue_depth = int(environ.get("queueDepth") or 10)
+    db_backend = environ.get("dbBackend", "mongo")
+    db_path = environ.get("dbPath", "dnd-bot.sqlite3")
+    db_host = environ.get("dbHost", "localhost")
+    db_port = int(environ.get("dbPort") or 27017)
+    db_password = environ.get("dbPassword")
+    db_cache_bytes = int(environ.get("dbCacheBytes", str(8 * 1024 * 1024)))
+    db_change_streams = environ.get("dbChangeStreams", "false").lower() == "true"
+    db_health_interval = float(environ.get("dbHealthInterval", "30"))
+    db_health_timeout = float(environ.get("dbHealthTimeout", "2"))
+    db_write_behind = int(environ.get("dbWriteBehind") or 0)
+    alert_time = int(environ["alertTime"])
+    alert_concurrency = int(environ.get("alertConcurrency", "10"))
+    alert_rate = float(environ.get("alertRate", "40"))
+    metrics_host = environ.get("metricsHost", "127.0.0.1")
+    metrics_port = int(environ.get("metricsPort") or 0)
+
+# Set by supervisor.py for each worker it starts; unset, one process runs
+# every shard
+if environ.get("shardIds"):
+    shard_ids = [int(shard) for shard in environ["shardIds"].split(",")]
+    shard_count = int(environ["shardCount"])
+    # Each worker serves its metrics on its own port (0 = off)
+    metrics_port = int(environ.get("metricsPort") or 0)
+else:
+    shard_ids = None
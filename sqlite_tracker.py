@@ -0,0 +1,627 @@
+import json
+import sqlite3
+from asyncio import get_running_loop
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from helpers import Collections
+from tracker import (
+    ALERT_FIELDS,
+    SESSION_LISTS,
+    Tracker,
+    empty_counts,
+    summarize_session,
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS session_users (
+    guild INTEGER NOT NULL,
+    list TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (guild, list, id)
+);
+CREATE TABLE IF NOT EXISTS players (
+    guild INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (guild, id)
+);
+CREATE TABLE IF NOT EXISTS inventory_items (
+    guild INTEGER NOT NULL,
+    player_id INTEGER NOT NULL,
+    player_name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    item TEXT NOT NULL,
+    qty INTEGER NOT NULL,
+    PRIMARY KEY (guild, player_id, key)
+);
+CREATE TABLE IF NOT EXISTS config (
+    guild INTEGER PRIMARY KEY,
+    dm_id INTEGER NOT NULL,
+    dm_name TEXT NOT NULL,
+    "session-day" INTEGER,
+    "session-time" TEXT,
+    "meeting-room" INTEGER,
+    "first-alert" INTEGER,
+    "second-alert" INTEGER,
+    alerts INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS "config_first-alert" ON config ("first-alert")
+    WHERE alerts = 1;
+CREATE INDEX IF NOT EXISTS "config_second-alert" ON config ("second-alert")
+    WHERE alerts = 1;
+CREATE INDEX IF NOT EXISTS "config_session-day" ON config ("session-day")
+    WHERE alerts = 1;
+CREATE INDEX IF NOT EXISTS config_alerts ON config (alerts) WHERE alerts = 1;
+CREATE TABLE IF NOT EXISTS history (
+    guild INTEGER NOT NULL,
+    ended TEXT NOT NULL,
+    record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS history_guild ON history (guild, ended);
+CREATE TABLE IF NOT EXISTS player_stats (
+    guild INTEGER NOT NULL,
+    player_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    sessions INTEGER NOT NULL,
+    attended INTEGER NOT NULL,
+    declined INTEGER NOT NULL,
+    cancel_votes INTEGER NOT NULL,
+    streak INTEGER NOT NULL,
+    best_streak INTEGER NOT NULL,
+    PRIMARY KEY (guild, player_id)
+);
+CREATE TABLE IF NOT EXISTS guild_stats (
+    guild INTEGER PRIMARY KEY,
+    sessions INTEGER NOT NULL,
+    cancelled INTEGER NOT NULL,
+    attended INTEGER NOT NULL
+);
+"""
+
+# Every statement the tracker runs against a table, with sample parameters,
+# for check_indexes
+QUERY_SHAPES = [
+    ("sessions by guild", "SELECT * FROM session_users WHERE guild = ?", (0,)),
+    ("players by guild", "SELECT * FROM players WHERE guild = ?", (0,)),
+    ("config by guild", "SELECT * FROM config WHERE guild = ?", (0,)),
+    (
+        "inventories by guild",
+        "SELECT * FROM inventory_items WHERE guild = ?",
+        (0,),
+    ),
+    (
+        "inventory by player",
+        "SELECT * FROM inventory_items WHERE guild = ? AND player_id = ?",
+        (0, 0),
+    ),
+    ("history by guild", "SELECT * FROM history WHERE guild = ?", (0,)),
+    (
+        "player stats by player",
+        "SELECT * FROM player_stats WHERE guild = ? AND player_id = ?",
+        (0, 0),
+    ),
+    ("guild stats by guild", "SELECT * FROM guild_stats WHERE guild = ?", (0,)),
+    ("config with alerts", "SELECT * FROM config WHERE alerts = 1", ()),
+    (
+        "config with alerts by guilds",
+        "SELECT * FROM config WHERE alerts = 1 "
+        "AND guild IN (SELECT value FROM json_each(?))",
+        ("[0]",),
+    ),
+] + [
+    (
+        f"config by {field}",
+        f'SELECT * FROM config WHERE alerts = 1 AND "{field}" = ?',
+        (0,),
+    )
+    for field in ALERT_FIELDS
+]
+
+PARTY_COUNTS = """
+SELECT p.guild,
+       COUNT(*) AS registered,
+       COUNT(a.id) AS attending,
+       COUNT(d.id) AS declined
+FROM players p
+LEFT JOIN session_users a
+    ON a.guild = p.guild AND a.list = 'attendees' AND a.id = p.id
+LEFT JOIN session_users d
+    ON d.guild = p.guild AND d.list = 'decliners' AND d.id = p.id
+WHERE p.guild IN (SELECT value FROM json_each(?))
+GROUP BY p.guild
+"""
+
+PLAYER_ROLLUP = """
+INSERT INTO player_stats
+    (guild, player_id, name, sessions, attended, declined, cancel_votes,
+     streak, best_streak)
+VALUES (?, ?, ?, 1, ?, ?, ?, ?, ?)
+ON CONFLICT (guild, player_id) DO UPDATE SET
+    name = excluded.name,
+    sessions = sessions + 1,
+    attended = attended + excluded.attended,
+    declined = declined + excluded.declined,
+    cancel_votes = cancel_votes + excluded.cancel_votes,
+    streak = CASE WHEN excluded.attended THEN streak + 1 ELSE 0 END,
+    best_streak = MAX(
+        best_streak, CASE WHEN excluded.attended THEN streak + 1 ELSE 0 END
+    )
+"""
+
+GUILD_ROLLUP = """
+INSERT INTO guild_stats (guild, sessions, cancelled, attended) VALUES (?, 1, ?, ?)
+ON CONFLICT (guild) DO UPDATE SET
+    sessions = sessions + 1,
+    cancelled = cancelled + excluded.cancelled,
+    attended = attended + excluded.attended
+"""
+
+CONFIG_COLUMNS = (
+    'guild, dm_id, dm_name, "session-day", "session-time", "meeting-room", '
+    '"first-alert", "second-alert", alerts'
+)
+
+
+def _config_doc(row):
+    return {
+        "guild": row["guild"],
+        "config": {
+            "session-dm": {"name": row["dm_name"], "id": row["dm_id"]},
+            "session-day": row["session-day"],
+            "session-time": row["session-time"],
+            "meeting-room": row["meeting-room"],
+            "first-alert": row["first-alert"],
+            "second-alert": row["second-alert"],
+            "alerts": bool(row["alerts"]),
+        },
+    }
+
+
+def _users(rows):
+    return [{"name": row["name"], "id": row["id"]} for row in rows]
+
+
+class SQLiteTracker(Tracker):
+    # Embedded backend for single-host deployments. sqlite3 blocks, so every
+    # statement runs on one worker thread that owns the connection; that also
+    # serializes writes the way SQLite wants them.
+    unavailable_errors = (sqlite3.OperationalError,)
+
+    def __init__(self, path="dnd-bot.sqlite3", cache=None):
+        super().__init__(cache)
+        self.path = path
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="sqlite")
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            conn = sqlite3.connect(
+                self.path, check_same_thread=False, cached_statements=256
+            )
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.execute("PRAGMA foreign_keys = ON")
+            self._conn = conn
+        return self._conn
+
+    async def _run(self, fn, *args):
+        # fn(conn, *args) runs in a transaction on the worker thread
+        def call():
+            conn = self._connect()
+            with conn:
+                return fn(conn, *args)
+
+        return await get_running_loop().run_in_executor(self._executor, call)
+
+    async def _fetchall(self, sql, params=()):
+        return await self._run(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def _fetchone(self, sql, params=()):
+        return await self._run(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def ensure_indexes(self):
+        await self._run(lambda conn: conn.executescript(SCHEMA))
+
+    async def check_indexes(self):
+        # Returns the names of the queries SQLite would answer with a table scan
+        def explain(conn):
+            failures = []
+            for name, sql, params in QUERY_SHAPES:
+                plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+                if any(
+                    row["detail"].startswith("SCAN")
+                    and "VIRTUAL TABLE" not in row["detail"]
+                    for row in plan
+                ):
+                    failures.append(name)
+            return failures
+
+        return await self._run(explain)
+
+    async def ping(self):
+        try:
+            await self._fetchone("SELECT 1")
+        except sqlite3.Error:
+            return False
+        return True
+
+    # Sessions
+
+    async def _load_session(self, guild_id):
+        return self._group_session(
+            await self._fetchall(
+                "SELECT list, id, name FROM session_users WHERE guild = ? "
+                "ORDER BY rowid",
+                (guild_id,),
+            )
+        )
+
+    @staticmethod
+    def _group_session(rows):
+        if not rows:
+            return None
+        session = {name: [] for name in SESSION_LISTS}
+        for row in rows:
+            session[Collections(row["list"])].append(
+                {"name": row["name"], "id": row["id"]}
+            )
+        return session
+
+    async def _add_session_user(self, guild_id, name, user):
+        return await self._run(
+            lambda conn: conn.execute(
+                "INSERT OR IGNORE INTO session_users (guild, list, id, name) "
+                "VALUES (?, ?, ?, ?)",
+                (guild_id, name.value, user["id"], user["name"]),
+            ).rowcount
+        )
+
+    async def _rm_session_user(self, guild_id, name, user):
+        return await self._run(
+            lambda conn: conn.execute(
+                "DELETE FROM session_users WHERE guild = ? AND list = ? AND id = ?",
+                (guild_id, name.value, user["id"]),
+            ).rowcount
+        )
+
+    async def _move_session_user(self, guild_id, user, to, away_from):
+        def move(conn):
+            conn.execute(
+                "DELETE FROM session_users WHERE guild = ? AND list = ? AND id = ?",
+                (guild_id, away_from.value, user["id"]),
+            )
+            conn.execute(
+                "INSERT OR IGNORE INTO session_users (guild, list, id, name) "
+                "VALUES (?, ?, ?, ?)",
+                (guild_id, to.value, user["id"], user["name"]),
+            )
+            return self._group_session(
+                conn.execute(
+                    "SELECT list, id, name FROM session_users WHERE guild = ? "
+                    "ORDER BY rowid",
+                    (guild_id,),
+                ).fetchall()
+            )
+
+        return await self._run(move)
+
+    async def _move_session_users(self, moves):
+        # Coalesced moves are one per user and pair of lists, so all the
+        # deletes can go before all the inserts, in one transaction
+        def move(conn):
+            conn.executemany(
+                "DELETE FROM session_users WHERE guild = ? AND list = ? AND id = ?",
+                [
+                    (guild_id, away.value, user["id"])
+                    for guild_id, user, _, away in moves
+                ],
+            )
+            conn.executemany(
+                "INSERT OR IGNORE INTO session_users (guild, list, id, name) "
+                "VALUES (?, ?, ?, ?)",
+                [
+                    (guild_id, to.value, user["id"], user["name"])
+                    for guild_id, user, to, _ in moves
+                ],
+            )
+
+        return await self._run(move)
+
+    async def _reset_sessions(self, guild_ids):
+        # Archives and clears every session in one transaction
+        def reset(conn):
+            guilds = json.dumps(guild_ids)
+            sessions, registered = {}, {}
+            for row in conn.execute(
+                "SELECT guild, list, id, name FROM session_users "
+                "WHERE guild IN (SELECT value FROM json_each(?)) ORDER BY rowid",
+                (guilds,),
+            ):
+                lists = sessions.setdefault(
+                    row["guild"], {name: [] for name in SESSION_LISTS}
+                )
+                lists[Collections(row["list"])].append(
+                    {"name": row["name"], "id": row["id"]}
+                )
+            for row in conn.execute(
+                "SELECT guild, id, name FROM players "
+                "WHERE guild IN (SELECT value FROM json_each(?))",
+                (guilds,),
+            ):
+                registered.setdefault(row["guild"], []).append(
+                    {"name": row["name"], "id": row["id"]}
+                )
+            ended = datetime.now(timezone.utc).isoformat()
+            history, guild_rows, player_rows = [], [], []
+            for guild_id, lists in sessions.items():
+                record, players = summarize_session(lists, registered.get(guild_id, []))
+                history.append((guild_id, ended, json.dumps(record)))
+                guild_rows.append(
+                    (
+                        guild_id,
+                        int(record["cancelled"]),
+                        len(record[Collections.ATTENDEES.value]),
+                    )
+                )
+                for player, flags in players:
+                    attended = int(flags["attended"])
+                    player_rows.append(
+                        (
+                            guild_id,
+                            player["id"],
+                            player["name"],
+                            attended,
+                            int(flags["declined"]),
+                            int(flags["cancel_votes"]),
+                            attended,
+                            attended,
+                        )
+                    )
+            conn.executemany(
+                "INSERT INTO history (guild, ended, record) VALUES (?, ?, ?)", history
+            )
+            conn.executemany(GUILD_ROLLUP, guild_rows)
+            conn.executemany(PLAYER_ROLLUP, player_rows)
+            conn.execute(
+                "DELETE FROM session_users "
+                "WHERE guild IN (SELECT value FROM json_each(?))",
+                (guilds,),
+            )
+            return len(sessions)
+
+        return await self._run(reset)
+
+    async def _load_stats(self, guild_id, player_id):
+        def stats(conn):
+            found = conn.execute(
+                "SELECT * FROM player_stats WHERE guild = ? AND player_id = ?",
+                (guild_id, player_id),
+            ).fetchone()
+            guild = conn.execute(
+                "SELECT * FROM guild_stats WHERE guild = ?", (guild_id,)
+            ).fetchone()
+            if found is not None:
+                found = dict(found)
+                found["player"] = {
+                    "name": found.pop("name"),
+                    "id": found.pop("player_id"),
+                }
+            return found, None if guild is None else dict(guild)
+
+        return await self._run(stats)
+
+    # Players
+
+    async def _load_players(self, guild_id):
+        rows = await self._fetchall(
+            "SELECT id, name FROM players WHERE guild = ? ORDER BY rowid", (guild_id,)
+        )
+        return _users(rows) or None
+
+    async def _load_players_page(self, guild_id, offset, limit):
+        def load(conn):
+            rows = conn.execute(
+                "SELECT id, name FROM players WHERE guild = ? "
+                "ORDER BY rowid LIMIT ? OFFSET ?",
+                (guild_id, limit, offset),
+            ).fetchall()
+            (total,) = conn.execute(
+                "SELECT COUNT(*) FROM players WHERE guild = ?", (guild_id,)
+            ).fetchone()
+            return _users(rows), total
+
+        return await self._run(load)
+
+    async def _add_player(self, guild_id, user):
+        return await self._run(
+            lambda conn: conn.execute(
+                "INSERT OR IGNORE INTO players (guild, id, name) VALUES (?, ?, ?)",
+                (guild_id, user["id"], user["name"]),
+            ).rowcount
+        )
+
+    async def _rm_player(self, guild_id, user):
+        return await self._run(
+            lambda conn: conn.execute(
+                "DELETE FROM players WHERE guild = ? AND id = ?",
+                (guild_id, user["id"]),
+            ).rowcount
+        )
+
+    async def _party_counts(self, guild_ids):
+        counts = {guild_id: empty_counts() for guild_id in guild_ids}
+        for row in await self._fetchall(PARTY_COUNTS, (json.dumps(guild_ids),)):
+            row = dict(row)
+            row["outstanding"] = max(
+                0, row["registered"] - row["attending"] - row["declined"]
+            )
+            counts[row.pop("guild")] = row
+        return counts
+
+    # Inventories
+
+    async def _find_inventories(self, guild_id):
+        rows = await self._fetchall(
+            "SELECT player_id, player_name, key, item, qty FROM inventory_items "
+            "WHERE guild = ? ORDER BY player_id, rowid",
+            (guild_id,),
+        )
+        inventories = {}
+        for row in rows:
+            inventory = inventories.setdefault(
+                row["player_id"],
+                {
+                    "guild": guild_id,
+                    "player": {"name": row["player_name"], "id": row["player_id"]},
+                    "items": {},
+                },
+            )
+            inventory["items"][row["key"]] = {"item": row["item"], "qty": row["qty"]}
+        for inventory in inventories.values():
+            yield inventory
+
+    async def _load_items(self, guild_id, player_id):
+        rows = await self._fetchall(
+            "SELECT key, item, qty FROM inventory_items "
+            "WHERE guild = ? AND player_id = ? ORDER BY rowid",
+            (guild_id, player_id),
+        )
+        return {row["key"]: {"item": row["item"], "qty": row["qty"]} for row in rows}
+
+    async def _load_items_page(self, guild_id, player_id, offset, limit):
+        def load(conn):
+            rows = conn.execute(
+                "SELECT item, qty FROM inventory_items "
+                "WHERE guild = ? AND player_id = ? ORDER BY rowid LIMIT ? OFFSET ?",
+                (guild_id, player_id, limit, offset),
+            ).fetchall()
+            (total,) = conn.execute(
+                "SELECT COUNT(*) FROM inventory_items "
+                "WHERE guild = ? AND player_id = ?",
+                (guild_id, player_id),
+            ).fetchone()
+            return [{"item": row["item"], "qty": row["qty"]} for row in rows], total
+
+        return await self._run(load)
+
+    async def _add_items(self, guild_id, user, names, totals):
+        def add(conn):
+            conn.execute(
+                "UPDATE inventory_items SET player_name = ? "
+                "WHERE guild = ? AND player_id = ?",
+                (user["name"], guild_id, user["id"]),
+            )
+            conn.executemany(
+                "INSERT INTO inventory_items "
+                "(guild, player_id, player_name, key, item, qty) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (guild, player_id, key) DO UPDATE SET "
+                "item = excluded.item, qty = qty + excluded.qty",
+                [
+                    (guild_id, user["id"], user["name"], key, names[key], qty)
+                    for key, qty in totals.items()
+                ],
+            )
+
+        return await self._run(add)
+
+    async def _set_item_quantities(self, guild_id, player_id, quantities):
+        return await self._run(
+            lambda conn: conn.executemany(
+                "UPDATE inventory_items SET qty = ? "
+                "WHERE guild = ? AND player_id = ? AND key = ?",
+                [(qty, guild_id, player_id, key) for key, qty in quantities.items()],
+            ).rowcount
+        )
+
+    async def _use_item(self, guild_id, player_id, key, qty):
+        def use(conn):
+            found = conn.execute(
+                "UPDATE inventory_items SET qty = qty - ? "
+                "WHERE guild = ? AND player_id = ? AND key = ? AND qty >= ? "
+                "RETURNING qty",
+                (qty, guild_id, player_id, key, qty),
+            ).fetchone()
+            if found is None:
+                return None
+            if found["qty"] <= 0:
+                conn.execute(
+                    "DELETE FROM inventory_items "
+                    "WHERE guild = ? AND player_id = ? AND key = ?",
+                    (guild_id, player_id, key),
+                )
+            return found["qty"]
+
+        return await self._run(use)
+
+    async def _rm_item(self, guild_id, player_id, key):
+        return await self._run(
+            lambda conn: conn.execute(
+                "DELETE FROM inventory_items "
+                "WHERE guild = ? AND player_id = ? AND key = ?",
+                (guild_id, player_id, key),
+            ).rowcount
+        )
+
+    # Config
+
+    async def _load_config(self, guild_id):
+        row = await self._fetchone(
+            f"SELECT {CONFIG_COLUMNS} FROM config WHERE guild = ?", (guild_id,)
+        )
+        return None if row is None else _config_doc(row)["config"]
+
+    async def _save_config(self, guild_id, config):
+        def save(conn):
+            conn.execute(
+                f"INSERT OR REPLACE INTO config ({CONFIG_COLUMNS}) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    guild_id,
+                    config["session-dm"]["id"],
+                    config["session-dm"]["name"],
+                    config["session-day"],
+                    config["session-time"],
+                    config["meeting-room"],
+                    config["first-alert"],
+                    config["second-alert"],
+                    int(config["alerts"]),
+                ),
+            )
+            return _config_doc(
+                conn.execute(
+                    f"SELECT {CONFIG_COLUMNS} FROM config WHERE guild = ?",
+                    (guild_id,),
+                ).fetchone()
+            )
+
+        return await self._run(save)
+
+    async def _disable_alerts(self, guild_id):
+        return await self._run(
+            lambda conn: conn.execute(
+                "UPDATE config SET alerts = 0 WHERE guild = ?", (guild_id,)
+            ).rowcount
+        )
+
+    async def _rm_config(self, guild_id):
+        return await self._run(
+            lambda conn: conn.execute(
+                "DELETE FROM config WHERE guild = ?", (guild_id,)
+            ).rowcount
+        )
+
+    async def _find_configs(self, field=None, day_of_the_week=None, guild_ids=None):
+        sql = f"SELECT {CONFIG_COLUMNS} FROM config WHERE alerts = 1"
+        params = ()
+        if field is not None:
+            sql += f' AND "{field}" = ?'
+            params = (day_of_the_week,)
+        if guild_ids is not None:
+            sql += " AND guild IN (SELECT value FROM json_each(?))"
+            params += (json.dumps(list(guild_ids)),)
+        for row in await self._fetchall(sql, params):
+            yield _config_doc(row)
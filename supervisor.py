@@ -0,0 +1,90 @@
+from asyncio import create_subprocess_exec, gather, get_running_loop, run, sleep
+from datetime import datetime
+from os import environ
+from signal import SIGINT, SIGTERM
+from sys import executable, exit
+from time import monotonic
+
+from settings import db_backend, metrics_port, shard_count, workers
+
+# Discord allows one gateway IDENTIFY every 5 seconds per bot
+IDENTIFY_INTERVAL = 5
+# A worker that lived this long is restarted straight away
+HEALTHY_RUN = 60
+MAX_BACKOFF = 60
+
+
+def log(message):
+    print(f"[{datetime.now().replace(microsecond=0)}] - Supervisor: {message}")
+
+
+def assign_shards(shard_count, workers):
+    # Shards are dealt round robin, so busy low-numbered shards spread out
+    return [list(range(shard_count))[i::workers] for i in range(workers)]
+
+
+class Worker:
+    def __init__(self, index, shard_ids, shard_count, delay):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.delay = delay
+        self.process = None
+        self.stopping = False
+
+    async def start(self):
+        env = dict(
+            environ,
+            shardIds=",".join(map(str, self.shard_ids)),
+            shardCount=str(self.shard_count),
+            # Workers can't share the port; worker i serves on metrics port + i
+            metricsPort=str(metrics_port + self.index if metrics_port else 0),
+        )
+        self.process = await create_subprocess_exec(executable, "bot.py", env=env)
+        log(f"worker {self.index} (shards {self.shard_ids}) is pid {self.process.pid}")
+
+    async def supervise(self):
+        # Runs the worker until stop(), restarting it with backoff when it dies
+        await sleep(self.delay)
+        backoff = 1
+        while not self.stopping:
+            started = monotonic()
+            await self.start()
+            code = await self.process.wait()
+            if self.stopping:
+                break
+            backoff = 1 if monotonic() - started > HEALTHY_RUN else backoff
+            log(f"worker {self.index} exited with {code}; restarting in {backoff}s")
+            await sleep(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+
+    def stop(self):
+        self.stopping = True
+        if self.process is not None and self.process.returncode is None:
+            self.process.terminate()
+
+
+async def main():
+    if db_backend == "memory" and workers > 1:
+        exit("The memory backend can't be shared between workers")
+    count = max(shard_count, workers)
+    pool = []
+    for index, shard_ids in enumerate(assign_shards(count, workers)):
+        # Stagger start-up so the workers' shards don't identify at once
+        delay = sum(len(worker.shard_ids) for worker in pool) * IDENTIFY_INTERVAL
+        pool.append(Worker(index, shard_ids, count, delay))
+    log(f"running {count} shards across {workers} workers")
+
+    def stop():
+        log("stopping workers")
+        for worker in pool:
+            worker.stop()
+
+    for sig in (SIGINT, SIGTERM):
+        get_running_loop().add_signal_handler(sig, stop)
+    await gather(*(worker.supervise() for worker in pool))
+    log("all workers stopped")
+
+
+if __name__ == "__main__":
+    run(main())
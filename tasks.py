@@ -1,37 +1,173 @@
+from asyncio import Lock, Semaphore, gather, sleep
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime
+from time import monotonic
+from discord import Forbidden, NotFound
+from cache import MISSING, LRUCache
 from helpers import plist
-from typing import Any
+from typing import Any, Awaitable, Callable, Iterable
+
+
+class RateLimiter:
+    # Token bucket shared by every alert in a run. discord.py already waits out
+    # per-route 429s; this keeps a large fan-out under the global request limit.
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = monotonic()
+        self.lock = Lock()
+
+    async def acquire(self) -> None:
+        async with self.lock:
+            now = monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                await sleep((1 - self.tokens) / self.rate)
+                self.tokens = 1
+                self.updated = monotonic()
+            self.tokens -= 1
+
+
+class Resolver:
+    # Looks channels and users up in the gateway cache first, then in a bounded
+    # LRU, and only then over REST. Deleted or inaccessible objects are cached
+    # as None for negative_ttl so a dead config doesn't cost a call every run.
+    def __init__(
+        self,
+        bot,
+        maxsize: int = 1024,
+        ttl: float = 3600,
+        negative_ttl: float = 600,
+    ):
+        self.bot = bot
+        self.negative_ttl = negative_ttl
+        self.channels = LRUCache(maxsize, ttl)
+        self.users = LRUCache(maxsize, ttl)
+        self.counts: Counter = Counter()
+
+    async def _resolve(self, cache: LRUCache, object_id: int, get, fetch) -> Any:
+        found = get(object_id)
+        if found is not None:
+            self.counts["gateway"] += 1
+            return found
+        found = cache.get(object_id)
+        if found is not MISSING:
+            self.counts["cache" if found is not None else "negative"] += 1
+            return found
+        self.counts["rest"] += 1
+        try:
+            found = await fetch(object_id)
+        except (NotFound, Forbidden):
+            cache.set(object_id, None, self.negative_ttl)
+            return None
+        cache.set(object_id, found)
+        return found
+
+    async def channel(self, channel_id: int) -> Any:
+        return await self._resolve(
+            self.channels, channel_id, self.bot.get_channel, self.bot.fetch_channel
+        )
+
+    async def user(self, user_id: int) -> Any:
+        return await self._resolve(
+            self.users, user_id, self.bot.get_user, self.bot.fetch_user
+        )
+
+    def snapshot(self) -> Counter:
+        return Counter(self.counts)
+
+
+@dataclass
+class FanOutStats:
+    sent: int = 0
+    skipped: int = 0
+    failed: int = 0
+    elapsed: float = 0.0
+    worst_lateness: float = 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"sent {self.sent}, skipped {self.skipped}, failed {self.failed} "
+            f"in {self.elapsed:.2f}s (worst lateness {self.worst_lateness:.2f}s)"
+        )
 
 
 class BotTasks:
-    def __init__(self, bot):
+    def __init__(self, bot, concurrency: int = 10, rate: float = 40):
         self.bot = bot
+        self.resolver = Resolver(bot)
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rate)
+
+    async def fan_out(
+        self, alerts: Iterable, deliver: Callable[[Any], Awaitable[bool]]
+    ) -> FanOutStats:
+        # deliver returns False when it decided not to send (e.g. a full group)
+        stats = FanOutStats()
+        semaphore = Semaphore(self.concurrency)
+        start = monotonic()
 
-    async def first_alert(self, config) -> None:
-        channel: Any = await self.bot.fetch_channel(config["config"]["meeting-room"])
-        await channel.send(
-            f"Are we good for our D&D session? Please use either `{self.bot.command_prefix}rsvp accept` or `{self.bot.command_prefix}rsvp decline`."
+        async def run(alert):
+            async with semaphore:
+                await self.limiter.acquire()
+                try:
+                    sent = await deliver(alert)
+                except Exception as e:
+                    stats.failed += 1
+                    print(f"Alert {alert.kind.value} for {alert.guild} failed: {e!r}")
+                    return
+                if not sent:
+                    stats.skipped += 1
+                    return
+                stats.sent += 1
+                lateness = (datetime.now() - alert.when).total_seconds()
+                stats.worst_lateness = max(stats.worst_lateness, lateness)
+
+        await gather(*(run(alert) for alert in alerts))
+        stats.elapsed = monotonic() - start
+        return stats
+
+    async def _alert_channel(self, config, message: str) -> bool:
+        channel: Any = await self.resolver.channel(config["config"]["meeting-room"])
+        if channel is None:
+            print(f"We didn't get a channel when using config: {config}")
+            return False
+        await channel.send(message)
+        return True
+
+    async def first_alert(self, config) -> bool:
+        return await self._alert_channel(
+            config,
+            f"Are we good for our D&D session? Please use either `{self.bot.command_prefix}rsvp accept` or `{self.bot.command_prefix}rsvp decline`.",
         )
 
-    async def second_alert(self, config) -> None:
-        channel: Any = await self.bot.fetch_channel(config["config"]["meeting-room"])
-        await channel.send(
-            f"Please RSVP: `{self.bot.command_prefix}rsvp accept` or `{self.bot.command_prefix}rsvp decline`."
+    async def second_alert(self, config) -> bool:
+        return await self._alert_channel(
+            config,
+            f"Please RSVP: `{self.bot.command_prefix}rsvp accept` or `{self.bot.command_prefix}rsvp decline`.",
         )
 
-    async def session_alert(self, config) -> None:
-        channel: Any = await self.bot.fetch_channel(config["config"]["meeting-room"])
-        await channel.send(
-            f"Game tonight! Please RSVP: `{self.bot.command_prefix}rsvp accept` or `{self.bot.command_prefix}rsvp decline`."
+    async def session_alert(self, config) -> bool:
+        return await self._alert_channel(
+            config,
+            f"Game tonight! Please RSVP: `{self.bot.command_prefix}rsvp accept` or `{self.bot.command_prefix}rsvp decline`.",
         )
 
-    async def send_dm(self, config, tracker) -> None:
-        dm: Any = await self.bot.fetch_user(config["config"]["session-dm"]["id"])
+    async def send_dm(self, config, tracker) -> bool:
+        dm: Any = await self.resolver.user(config["config"]["session-dm"]["id"])
         if dm is None:
             print(f"We didn't get a user when using config: {config}")
-        else:
-            await dm.send(
-                f"Confirm List: {plist(tracker.get_attendees_for_guild(config['guild']))}\nDecline list: {plist(tracker.get_decliners_for_guild(config['guild']))}"
-            )
+            return False
+        attendees, decliners, _, _ = await tracker.get_all(config["guild"])
+        await dm.send(
+            f"Confirm List: {plist(attendees)}\nDecline list: {plist(decliners)}"
+        )
+        return True
+
+    async def reset(self, config, tracker) -> None:
+        await tracker.reset(config["guild"])
 
-    def reset(self, config, tracker) -> None:
-        tracker.reset(config["guild"])
+    async def reset_many(self, configs, tracker) -> dict:
+        return await tracker.reset_many({config["guild"] for config in configs})
@@ -0,0 +1,235 @@
+import asyncio
+import sys
+from os import environ, path
+from types import SimpleNamespace
+from uuid import uuid4
+
+import pytest
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from helpers import Collections  # noqa: E402
+from memory_tracker import MemoryTracker  # noqa: E402
+from sqlite_tracker import SQLiteTracker  # noqa: E402
+
+# Every backend must answer the Tracker API the same way. Mongo runs against
+# a real server (mongomock has no $setIntersection), at MONGO_URL or on
+# localhost, and is skipped when there isn't one.
+MONGO_URL = environ.get("MONGO_URL", "mongodb://localhost:27017")
+
+alice = SimpleNamespace(id=1, name="alice")
+bob = SimpleNamespace(id=2, name="bob")
+carol = SimpleNamespace(id=3, name="carol")
+
+
+def mongo_available():
+    try:
+        from pymongo import MongoClient
+
+        client = MongoClient(MONGO_URL, serverSelectionTimeoutMS=500)
+        try:
+            client.admin.command("ping")
+        finally:
+            client.close()
+    except Exception:
+        return False
+    return True
+
+
+@pytest.fixture(params=["memory", "sqlite", "mongo"])
+def make_tracker(request, tmp_path):
+    # Trackers are built inside each test's event loop, as Motor needs
+    if request.param == "memory":
+        yield MemoryTracker
+    elif request.param == "sqlite":
+        yield lambda: SQLiteTracker(str(tmp_path / "test.sqlite3"))
+    else:
+        if not mongo_available():
+            pytest.skip(f"no mongod at {MONGO_URL}")
+        from motor.motor_asyncio import AsyncIOMotorClient
+        from mongo_tracker import MongoTracker
+        from pymongo import MongoClient
+
+        name = f"dnd-bot-test-{uuid4().hex}"
+        yield lambda: MongoTracker(AsyncIOMotorClient(MONGO_URL)[name])
+        client = MongoClient(MONGO_URL)
+        client.drop_database(name)
+        client.close()
+
+
+def run(make_tracker, scenario):
+    async def main():
+        tracker = make_tracker()
+        await tracker.ensure_indexes()
+        await scenario(tracker)
+
+    asyncio.run(main())
+
+
+def ids(users):
+    return [user["id"] for user in users]
+
+
+def test_moves(make_tracker):
+    async def scenario(tracker):
+        session = await tracker.move_user_for_guild(1, alice, Collections.ATTENDEES)
+        assert ids(session[Collections.ATTENDEES]) == [1]
+        # Moving again changes nothing
+        await tracker.move_user_for_guild(1, alice, Collections.ATTENDEES)
+        session = await tracker.move_user_for_guild(1, alice, Collections.DECLINERS)
+        assert ids(session[Collections.ATTENDEES]) == []
+        assert ids(session[Collections.DECLINERS]) == [1]
+        await tracker.move_user_for_guild(1, bob, Collections.DREAMERS)
+        await tracker.move_user_for_guild(1, bob, Collections.CANCELLERS)
+        attendees, decliners, dreamers, cancellers = await tracker.get_all(1)
+        assert (ids(attendees), ids(decliners)) == ([], [1])
+        assert (ids(dreamers), ids(cancellers)) == ([], [2])
+        assert await tracker.get_all(2) == ([], [], [], [])
+
+    run(make_tracker, scenario)
+
+
+def test_party_counts(make_tracker):
+    async def scenario(tracker):
+        for player in (alice, bob, carol):
+            await tracker.register_player(1, player)
+        await tracker.register_player(2, alice)
+        await tracker.move_user_for_guild(1, alice, Collections.ATTENDEES)
+        await tracker.move_user_for_guild(1, bob, Collections.DECLINERS)
+        await tracker.move_user_for_guild(2, alice, Collections.ATTENDEES)
+        counts = await tracker.get_party_counts([1, 2, 3])
+        assert counts[1] == {
+            "registered": 3,
+            "attending": 1,
+            "declined": 1,
+            "outstanding": 1,
+        }
+        assert counts[2]["attending"] == counts[2]["registered"] == 1
+        assert counts[3]["registered"] == 0
+        assert not await tracker.is_full_group(1)
+        assert await tracker.is_full_group(2)
+        assert not await tracker.is_full_group(3)
+        players, total = await tracker.get_players_page(1, 1, 1)
+        assert (ids(players), total) == ([2], 3)
+
+    run(make_tracker, scenario)
+
+
+def test_inventory(make_tracker):
+    async def scenario(tracker):
+        assert await tracker.get_inventory_for_player(1, alice) == []
+        # Names are matched case- and space-insensitively, first spelling kept
+        await tracker.add_items_to_player_inventory(
+            1, alice, [("3", "Rope"), ("2", " rope"), ("1", "Torch")]
+        )
+        await tracker.add_to_player_inventory(1, alice, "Torch", "1")
+        items = await tracker.get_inventory_for_player(1, alice)
+        assert {item["item"]: item["qty"] for item in items} == {
+            "Rope": 5,
+            "Torch": 2,
+        }
+        missing = await tracker.update_player_inventory_items(
+            1, alice, [("7", "ROPE"), ("1", "Oil")]
+        )
+        assert missing == ["Oil"]
+        assert await tracker.use_from_player_inventory(1, alice, "rope", 2) == 5
+        # Too few and unknown items are left alone
+        assert await tracker.use_from_player_inventory(1, alice, "torch", 3) is None
+        assert await tracker.use_from_player_inventory(1, alice, "oil") is None
+        # Using the last one drops the item
+        assert await tracker.use_from_player_inventory(1, alice, "torch", 2) == 0
+        items, total = await tracker.get_inventory_page(1, alice, 0, 10)
+        assert (items, total) == ([{"item": "Rope", "qty": 5}], 1)
+        await tracker.add_items_to_player_inventory(
+            1, alice, [("1", name) for name in ("Chalk", "Oil", "Arrows")]
+        )
+        items, total = await tracker.get_inventory_page(1, alice, 1, 2)
+        assert (len(items), total) == (2, 4)
+        assert await tracker.get_inventory_for_player(1, bob) == []
+        assert await tracker.get_inventory_for_player(2, alice) == []
+
+    run(make_tracker, scenario)
+
+
+def test_config_queries(make_tracker):
+    async def scenario(tracker):
+        assert await tracker.get_config_for_guild(1) is None
+        for guild_id in (1, 2, 3):
+            await tracker.create_guild_config(
+                guild_id, alice, 5, "19:00", 10, guild_id, 4
+            )
+        config = await tracker.get_config_for_guild(1)
+        assert config["session-dm"]["id"] == alice.id
+        assert (config["session-day"], config["session-time"]) == (5, "19:00")
+        assert config["alerts"]
+
+        async def guilds(configs):
+            return sorted([config["guild"] async for config in configs])
+
+        assert await guilds(tracker.get_alert_configs()) == [1, 2, 3]
+        assert await guilds(tracker.get_alert_configs([1, 3, 9])) == [1, 3]
+        assert await guilds(tracker.get_first_alert_configs(2)) == [2]
+        assert await guilds(tracker.get_first_alert_configs(2, [1, 3])) == []
+        assert await guilds(tracker.get_second_alert_configs(4, [2, 3])) == [2, 3]
+        assert await guilds(tracker.get_session_day_configs(5, [1])) == [1]
+        assert await guilds(tracker.get_session_day_configs(6)) == []
+        # Skipped guilds stop alerting
+        await tracker.skip(2)
+        assert not (await tracker.get_config_for_guild(2))["alerts"]
+        assert await guilds(tracker.get_alert_configs()) == [1, 3]
+        await tracker.rm_guild_config(3)
+        assert await tracker.get_config_for_guild(3) is None
+        assert await guilds(tracker.get_alert_configs()) == [1]
+
+    run(make_tracker, scenario)
+
+
+def test_reset_and_stats(make_tracker):
+    async def scenario(tracker):
+        assert await tracker.get_stats(1, alice) == (None, None)
+        for player in (alice, bob):
+            await tracker.register_player(1, player)
+        await tracker.move_user_for_guild(1, alice, Collections.ATTENDEES)
+        await tracker.move_user_for_guild(1, bob, Collections.DECLINERS)
+        await tracker.move_user_for_guild(2, carol, Collections.ATTENDEES)
+        assert await tracker.reset_many([1, 2, 3]) == {"guilds": 3, "sessions": 2}
+        assert await tracker.get_all(1) == ([], [], [], [])
+        assert await tracker.get_all(2) == ([], [], [], [])
+
+        # A second session: bob attends, alice votes to cancel and it is
+        await tracker.move_user_for_guild(1, bob, Collections.ATTENDEES)
+        await tracker.move_user_for_guild(1, alice, Collections.CANCELLERS)
+        assert await tracker.reset(1) == {"guilds": 1, "sessions": 1}
+
+        player, guild = await tracker.get_stats(1, alice)
+        assert {key: guild[key] for key in ("sessions", "cancelled", "attended")} == {
+            "sessions": 2,
+            "cancelled": 1,
+            "attended": 2,
+        }
+        assert player["player"]["id"] == alice.id
+        assert {
+            key: player[key]
+            for key in (
+                "sessions",
+                "attended",
+                "declined",
+                "cancel_votes",
+                "streak",
+                "best_streak",
+            )
+        } == {
+            "sessions": 2,
+            "attended": 1,
+            "declined": 0,
+            "cancel_votes": 1,
+            "streak": 0,
+            "best_streak": 1,
+        }
+        player, _ = await tracker.get_stats(1, bob)
+        assert (player["attended"], player["declined"], player["streak"]) == (1, 1, 1)
+        player, guild = await tracker.get_stats(2, carol)
+        assert (player["sessions"], guild["sessions"]) == (1, 1)
+        assert await tracker.get_stats(3, alice) == (None, None)
+
+    run(make_tracker, scenario)
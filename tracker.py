@@ -0,0 +1,564 @@
+from abc import ABC, abstractmethod
+from collections import Counter
+from typing import Optional
+
+from cache import MISSING, GuildStateCache
+from health import CircuitBreaker
+from helpers import Collections, item_key
+from metrics import metrics
+from writebehind import WriteBehind
+
+# Per-guild lists that make up a session
+SESSION_LISTS = (
+    Collections.ATTENDEES,
+    Collections.DECLINERS,
+    Collections.DREAMERS,
+    Collections.CANCELLERS,
+)
+
+# Accepting clears a decline (and vice versa); same for dream/cancel votes
+OPPOSITE_LISTS = {
+    Collections.ATTENDEES: Collections.DECLINERS,
+    Collections.DECLINERS: Collections.ATTENDEES,
+    Collections.DREAMERS: Collections.CANCELLERS,
+    Collections.CANCELLERS: Collections.DREAMERS,
+}
+
+ALERT_FIELDS = ("first-alert", "second-alert", "session-day")
+
+
+def empty_counts():
+    return {"registered": 0, "attending": 0, "declined": 0, "outstanding": 0}
+
+
+def summarize_session(lists, registered):
+    # Splits a finished session into its history record (ids only) and the
+    # per-player flags its rollups are built from
+    ids = {name: {u["id"] for u in lists[name]} for name in SESSION_LISTS}
+    cancelled = len(ids[Collections.CANCELLERS]) > len(ids[Collections.DREAMERS])
+    record = {
+        "registered": sorted({p["id"] for p in registered}),
+        "cancelled": cancelled,
+        **{name.value: sorted(ids[name]) for name in SESSION_LISTS},
+    }
+    people = {u["id"]: u for u in registered}
+    for name in SESSION_LISTS:
+        people.update({u["id"]: u for u in lists[name]})
+    players = [
+        (
+            person,
+            {
+                "attended": person["id"] in ids[Collections.ATTENDEES],
+                "declined": person["id"] in ids[Collections.DECLINERS],
+                "cancel_votes": person["id"] in ids[Collections.CANCELLERS],
+            },
+        )
+        for person in people.values()
+    ]
+    return record, players
+
+
+def open_tracker(backend, cache=None, path=None, host=None, port=None, password=None):
+    # Backends are imported here so SQLite and in-memory setups never start
+    # a Mongo client
+    if backend == "sqlite":
+        from sqlite_tracker import SQLiteTracker
+
+        return SQLiteTracker(path, cache)
+    if backend == "memory":
+        from memory_tracker import MemoryTracker
+
+        return MemoryTracker(cache)
+    if backend != "mongo":
+        raise ValueError(f"Unknown db backend: {backend}")
+    from motor.motor_asyncio import AsyncIOMotorClient
+    from mongo_tracker import CommandTimer, MongoTracker
+
+    # Fail within seconds when the server is gone rather than the default 30
+    client = AsyncIOMotorClient(
+        host=host,
+        port=port,
+        password=password,
+        serverSelectionTimeoutMS=5000,
+        event_listeners=[CommandTimer()],
+    )
+    return MongoTracker(client["dnd-bot"], cache)
+
+
+class Tracker(ABC):
+    # Storage-independent half of the tracker: the public API, the read-through
+    # guild cache and its invalidation. Backends implement the _load_*/_store_*
+    # style primitives below against their own storage.
+    # Exceptions that mean the database can't be reached, as opposed to a
+    # failed operation; they count against the circuit breaker
+    unavailable_errors: tuple = ()
+
+    def __init__(self, cache=None):
+        self.cache = GuildStateCache() if cache is None else cache
+        self.breaker = CircuitBreaker()
+        self.write_behind: Optional[WriteBehind] = None
+
+    def enable_write_behind(self, interval: float) -> WriteBehind:
+        # RSVP and vote moves are buffered and written in bulk every
+        # `interval` seconds; the caller runs the returned buffer's run()
+        self.write_behind = WriteBehind(self._write_moves, interval)
+        return self.write_behind
+
+    async def _flush(self):
+        # Anything reading or rewriting sessions in the database itself must
+        # see the buffered moves first
+        if self.write_behind is not None:
+            await self.write_behind.flush()
+
+    async def ensure_indexes(self):
+        pass
+
+    async def check_indexes(self):
+        # Names of the queries the backend would answer with a full scan
+        return []
+
+    @abstractmethod
+    async def ping(self) -> bool:
+        pass
+
+    async def _db(self, operation, *args):
+        # Every round trip goes through the breaker, so commands fail fast
+        # while the database is known to be down
+        self.breaker.check()
+        try:
+            with metrics.time(
+                "dndbot_tracker_seconds", operation=operation.__name__.lstrip("_")
+            ):
+                result = await operation(*args)
+        except self.unavailable_errors:
+            self.breaker.failure()
+            raise
+        self.breaker.success()
+        return result
+
+    async def _cached(self, guild_id, key, load):
+        value = self.cache.get(guild_id, key)
+        if value is MISSING:
+            generation = self.cache.generation(guild_id)
+            value = await load()
+            self.cache.set(guild_id, key, value, generation)
+        return value
+
+    @staticmethod
+    def _get_user(user):
+        return {"name": user.name, "id": user.id}
+
+    @staticmethod
+    def _session_lists(session):
+        session = session or {}
+        return {name: session.get(name, []) for name in SESSION_LISTS}
+
+    # Sessions
+
+    @abstractmethod
+    async def _load_session(self, guild_id):
+        pass
+
+    @abstractmethod
+    async def _add_session_user(self, guild_id, name, user):
+        pass
+
+    @abstractmethod
+    async def _rm_session_user(self, guild_id, name, user):
+        pass
+
+    @abstractmethod
+    async def _move_session_user(self, guild_id, user, to, away_from):
+        # Atomically; returns the session lists as they are afterwards
+        pass
+
+    async def _move_session_users(self, moves):
+        # Bulk form of _move_session_user for (guild, user, to, away_from)
+        # tuples; backends that can do it in one round trip override it
+        for move in moves:
+            await self._move_session_user(*move)
+
+    @abstractmethod
+    async def _reset_sessions(self, guild_ids):
+        # Archives then deletes the sessions; returns how many there were
+        pass
+
+    async def get_session_for_guild(self, guild_id):
+        async def load():
+            return self._session_lists(await self._db(self._load_session, guild_id))
+
+        session = await self._cached(guild_id, Collections.SESSIONS, load)
+        if self.write_behind is not None:
+            session = self._apply_moves(session, self.write_behind.writes(guild_id))
+        return session
+
+    @staticmethod
+    def _apply_moves(session, moves):
+        # The session as it will be once the buffered moves are written,
+        # without touching the (shared) cached lists
+        session = dict(session)
+        for _, user, to, away_from in moves:
+            session[away_from] = [
+                u for u in session[away_from] if u["id"] != user["id"]
+            ]
+            if not any(u["id"] == user["id"] for u in session[to]):
+                session[to] = [*session[to], user]
+        return session
+
+    async def _write_moves(self, moves):
+        await self._db(self._move_session_users, moves)
+        for guild_id in {move[0] for move in moves}:
+            self.cache.invalidate(guild_id, Collections.SESSIONS)
+
+    async def get_all(self, guild_id):
+        session = await self.get_session_for_guild(guild_id)
+        return tuple(session[name] for name in SESSION_LISTS)
+
+    async def _get_session_list(self, guild_id, name):
+        return (await self.get_session_for_guild(guild_id))[name]
+
+    async def _add_to_session_list(self, guild_id, name, user):
+        await self._flush()
+        result = await self._db(
+            self._add_session_user, guild_id, name, self._get_user(user)
+        )
+        self.cache.invalidate(guild_id, Collections.SESSIONS)
+        return result
+
+    async def _rm_from_session_list(self, guild_id, name, user):
+        await self._flush()
+        result = await self._db(
+            self._rm_session_user, guild_id, name, self._get_user(user)
+        )
+        self.cache.invalidate(guild_id, Collections.SESSIONS)
+        return result
+
+    async def move_user_for_guild(self, guild_id, user, to):
+        if self.write_behind is not None:
+            # Fail fast like a direct write would rather than pile up moves
+            # that can't be flushed
+            self.breaker.check()
+            user = self._get_user(user)
+            pair = frozenset((to, OPPOSITE_LISTS[to]))
+            self.write_behind.add(
+                guild_id, (user["id"], pair), (guild_id, user, to, OPPOSITE_LISTS[to])
+            )
+            self.cache.touch(guild_id)
+            return await self.get_session_for_guild(guild_id)
+        generation = self.cache.generation(guild_id)
+        session = self._session_lists(
+            await self._db(
+                self._move_session_user,
+                guild_id,
+                self._get_user(user),
+                to,
+                OPPOSITE_LISTS[to],
+            )
+        )
+        self.cache.replace(guild_id, Collections.SESSIONS, session, generation)
+        return session
+
+    async def get_attendees_for_guild(self, guild_id):
+        return await self._get_session_list(guild_id, Collections.ATTENDEES)
+
+    async def get_decliners_for_guild(self, guild_id):
+        return await self._get_session_list(guild_id, Collections.DECLINERS)
+
+    async def get_cancellers_for_guild(self, guild_id):
+        return await self._get_session_list(guild_id, Collections.CANCELLERS)
+
+    async def get_dreamers_for_guild(self, guild_id):
+        return await self._get_session_list(guild_id, Collections.DREAMERS)
+
+    async def add_attendee_for_guild(self, guild_id, attendee):
+        return await self._add_to_session_list(
+            guild_id, Collections.ATTENDEES, attendee
+        )
+
+    async def rm_attendee_for_guild(self, guild_id, attendee):
+        return await self._rm_from_session_list(
+            guild_id, Collections.ATTENDEES, attendee
+        )
+
+    async def add_decliner_for_guild(self, guild_id, decliner):
+        return await self._add_to_session_list(
+            guild_id, Collections.DECLINERS, decliner
+        )
+
+    async def rm_decliner_for_guild(self, guild_id, decliner):
+        return await self._rm_from_session_list(
+            guild_id, Collections.DECLINERS, decliner
+        )
+
+    async def add_canceller_for_guild(self, guild_id, canceller):
+        return await self._add_to_session_list(
+            guild_id, Collections.CANCELLERS, canceller
+        )
+
+    async def rm_canceller_for_guild(self, guild_id, canceller):
+        return await self._rm_from_session_list(
+            guild_id, Collections.CANCELLERS, canceller
+        )
+
+    async def add_dreamer_for_guild(self, guild_id, dreamer):
+        return await self._add_to_session_list(guild_id, Collections.DREAMERS, dreamer)
+
+    async def rm_dreamer_for_guild(self, guild_id, dreamer):
+        return await self._rm_from_session_list(guild_id, Collections.DREAMERS, dreamer)
+
+    async def reset(self, guild_id):
+        return await self.reset_many([guild_id])
+
+    async def reset_many(self, guild_ids):
+        guild_ids = list(guild_ids)
+        await self._flush()
+        deleted = await self._db(self._reset_sessions, guild_ids)
+        for guild_id in guild_ids:
+            self.cache.invalidate(guild_id, Collections.SESSIONS)
+        return {"guilds": len(guild_ids), "sessions": deleted}
+
+    @abstractmethod
+    async def _load_stats(self, guild_id, player_id):
+        pass
+
+    async def get_stats(self, guild_id, player):
+        # Precomputed rollups; (player stats, guild stats), either may be None
+        return await self._db(self._load_stats, guild_id, player.id)
+
+    # Players
+
+    @abstractmethod
+    async def _load_players(self, guild_id):
+        pass
+
+    @abstractmethod
+    async def _add_player(self, guild_id, user):
+        pass
+
+    @abstractmethod
+    async def _rm_player(self, guild_id, user):
+        pass
+
+    @abstractmethod
+    async def _load_players_page(self, guild_id, offset, limit):
+        # (up to limit players from offset, number registered)
+        pass
+
+    async def get_players_for_guild(self, guild_id):
+        async def load():
+            return await self._db(self._load_players, guild_id)
+
+        return await self._cached(guild_id, Collections.PLAYERS, load)
+
+    async def get_players_page(self, guild_id, offset, limit):
+        # Not cached: only one page is ever held, and rendered pages are
+        # cached by the bot instead
+        return await self._db(self._load_players_page, guild_id, offset, limit)
+
+    async def add_player_for_guild(self, guild_id, player):
+        result = await self._db(self._add_player, guild_id, self._get_user(player))
+        self.cache.invalidate(guild_id, Collections.PLAYERS)
+        return result
+
+    async def rm_player_for_guild(self, guild_id, player):
+        result = await self._db(self._rm_player, guild_id, self._get_user(player))
+        self.cache.invalidate(guild_id, Collections.PLAYERS)
+        return result
+
+    async def register_player(self, guild_id: int, player):
+        return await self.add_player_for_guild(guild_id, player)
+
+    async def unregister_player(self, guild_id: int, player):
+        return await self.rm_player_for_guild(guild_id, player)
+
+    @abstractmethod
+    async def _party_counts(self, guild_ids):
+        pass
+
+    async def get_party_counts(self, guild_ids):
+        # Registered/attending/declined/outstanding player counts per guild,
+        # in one query for any number of guilds
+        await self._flush()
+        return await self._db(self._party_counts, list(guild_ids))
+
+    @staticmethod
+    def is_full(counts) -> bool:
+        return counts["registered"] > 0 and counts["attending"] >= counts["registered"]
+
+    async def is_full_group(self, guild_id: int) -> bool:
+        return self.is_full((await self.get_party_counts([guild_id]))[guild_id])
+
+    # Inventories
+
+    @abstractmethod
+    def _find_inventories(self, guild_id):
+        # Async iterable of {guild, player, items} documents
+        pass
+
+    def get_inventories_for_guild(self, guild_id):
+        self.breaker.check()
+        return self._find_inventories(guild_id)
+
+    @abstractmethod
+    async def _load_items(self, guild_id, player_id):
+        pass
+
+    @abstractmethod
+    async def _load_items_page(self, guild_id, player_id, offset, limit):
+        # (up to limit {item, qty} entries from offset, number of items)
+        pass
+
+    @abstractmethod
+    async def _add_items(self, guild_id, user, names, totals):
+        pass
+
+    @abstractmethod
+    async def _set_item_quantities(self, guild_id, player_id, quantities):
+        pass
+
+    @abstractmethod
+    async def _use_item(self, guild_id, player_id, key, qty):
+        # Returns what's left, or None when the player doesn't hold enough
+        pass
+
+    @abstractmethod
+    async def _rm_item(self, guild_id, player_id, key):
+        pass
+
+    async def _get_items_for_player(self, guild_id, player):
+        async def load():
+            return await self._db(self._load_items, guild_id, player.id)
+
+        return await self._cached(guild_id, (Collections.INVENTORIES, player.id), load)
+
+    async def get_inventory_for_player(self, guild_id, player):
+        return list((await self._get_items_for_player(guild_id, player)).values())
+
+    async def get_inventory_page(self, guild_id, player, offset, limit):
+        return await self._db(self._load_items_page, guild_id, player.id, offset, limit)
+
+    async def add_to_player_inventory(self, guild_id, player, item, qty):
+        return await self.add_items_to_player_inventory(guild_id, player, [(qty, item)])
+
+    async def add_items_to_player_inventory(self, guild_id, player, items):
+        names, totals = {}, Counter()
+        for qty, item in items:
+            key = item_key(item)
+            names.setdefault(key, item.strip())
+            totals[key] += int(qty)
+        result = await self._db(
+            self._add_items, guild_id, self._get_user(player), names, dict(totals)
+        )
+        self.cache.invalidate(guild_id, (Collections.INVENTORIES, player.id))
+        return result
+
+    async def update_player_inventory(self, guild_id, player, item, qty):
+        return await self.update_player_inventory_items(guild_id, player, [(qty, item)])
+
+    async def update_player_inventory_items(self, guild_id, player, items):
+        # Sets every held item's quantity in one write; returns the items
+        # that aren't in the inventory and so were left alone
+        held = await self._get_items_for_player(guild_id, player)
+        found = {
+            item_key(item): int(qty) for qty, item in items if item_key(item) in held
+        }
+        missing = [item for _, item in items if item_key(item) not in held]
+        if found:
+            await self._db(self._set_item_quantities, guild_id, player.id, found)
+            self.cache.invalidate(guild_id, (Collections.INVENTORIES, player.id))
+        return missing
+
+    async def use_from_player_inventory(self, guild_id, player, item, qty=1):
+        left = await self._db(self._use_item, guild_id, player.id, item_key(item), qty)
+        if left is not None:
+            self.cache.invalidate(guild_id, (Collections.INVENTORIES, player.id))
+        return left
+
+    async def rm_from_player_inventory(self, guild_id, player, item):
+        result = await self._db(self._rm_item, guild_id, player.id, item_key(item))
+        self.cache.invalidate(guild_id, (Collections.INVENTORIES, player.id))
+        return result
+
+    # Config
+
+    @abstractmethod
+    async def _load_config(self, guild_id):
+        pass
+
+    @abstractmethod
+    async def _save_config(self, guild_id, config):
+        # Returns the stored {guild, config} document
+        pass
+
+    @abstractmethod
+    async def _disable_alerts(self, guild_id):
+        pass
+
+    @abstractmethod
+    async def _rm_config(self, guild_id):
+        pass
+
+    @abstractmethod
+    def _find_configs(self, field=None, day_of_the_week=None, guild_ids=None):
+        # Async iterable of alerting {guild, config} documents, optionally
+        # only those whose config[field] is day_of_the_week, and only for
+        # guild_ids when a sharded worker owns just some of the guilds
+        pass
+
+    async def get_config_for_guild(self, guild_id):
+        async def load():
+            return await self._db(self._load_config, guild_id)
+
+        return await self._cached(guild_id, Collections.CONFIG, load)
+
+    async def create_guild_config(
+        self,
+        guild_id,
+        dm_user,
+        session_day,
+        session_time,
+        meeting_room,
+        first_alert,
+        second_alert,
+    ):
+        result = await self._db(
+            self._save_config,
+            guild_id,
+            {
+                "session-dm": self._get_user(dm_user),
+                "session-day": session_day,
+                "session-time": str(session_time),
+                "meeting-room": meeting_room,
+                "first-alert": first_alert,
+                "second-alert": second_alert,
+                "alerts": True,
+            },
+        )
+        self.cache.invalidate(guild_id, Collections.CONFIG)
+        return result
+
+    async def skip(self, guild_id):
+        result = await self._db(self._disable_alerts, guild_id)
+        self.cache.invalidate(guild_id, Collections.CONFIG)
+        return result
+
+    async def rm_guild_config(self, guild_id):
+        result = await self._db(self._rm_config, guild_id)
+        self.cache.invalidate(guild_id, Collections.CONFIG)
+        return result
+
+    def _configs(self, field=None, day_of_the_week=None, guild_ids=None):
+        self.breaker.check()
+        return self._find_configs(field, day_of_the_week, guild_ids)
+
+    def get_alert_configs(self, guild_ids=None):
+        return self._configs(guild_ids=guild_ids)
+
+    def get_first_alert_configs(self, day_of_the_week: int, guild_ids=None):
+        return self._configs("first-alert", day_of_the_week, guild_ids)
+
+    def get_second_alert_configs(self, day_of_the_week: int, guild_ids=None):
+        return self._configs("second-alert", day_of_the_week, guild_ids)
+
+    def get_session_day_configs(self, day_of_the_week: int, guild_ids=None):
+        return self._configs("session-day", day_of_the_week, guild_ids)
@@ -0,0 +1,75 @@
+from asyncio import CancelledError, Lock, sleep
+from time import monotonic
+from typing import Awaitable, Callable, Dict, Hashable, Iterator, List, Optional
+
+from metrics import metrics
+
+
+class WriteBehind:
+    # Buffers writes per guild for up to `interval` seconds and hands them to
+    # `write` as one batch. A write under a key already buffered replaces it,
+    # so only the final state of each key reaches the database.
+    def __init__(self, write: Callable[[List[tuple]], Awaitable], interval: float):
+        self.write = write
+        self.interval = interval
+        # guild -> key -> write, oldest first
+        self.pending: Dict[int, Dict[Hashable, tuple]] = {}
+        # What the current flush is writing, still visible to readers
+        self.flushing: Dict[int, Dict[Hashable, tuple]] = {}
+        self.oldest: Optional[float] = None
+        self.lock = Lock()
+
+    def __len__(self) -> int:
+        return sum(len(writes) for writes in self.pending.values())
+
+    def add(self, guild_id: int, key: Hashable, write: tuple) -> None:
+        writes = self.pending.setdefault(guild_id, {})
+        writes.pop(key, None)
+        writes[key] = write
+        if self.oldest is None:
+            self.oldest = monotonic()
+
+    def writes(self, guild_id: int) -> Iterator[tuple]:
+        # Everything not yet in the database for the guild, in order
+        yield from self.flushing.get(guild_id, {}).values()
+        yield from self.pending.get(guild_id, {}).values()
+
+    async def flush(self) -> None:
+        async with self.lock:
+            if not self.pending:
+                return
+            self.flushing, self.pending = self.pending, {}
+            oldest, self.oldest = self.oldest, None
+            batch = [
+                write for writes in self.flushing.values() for write in writes.values()
+            ]
+            try:
+                await self.write(batch)
+            except Exception:
+                # Back in the queue, under anything buffered meanwhile
+                for guild_id, writes in self.flushing.items():
+                    self.pending[guild_id] = {
+                        **writes,
+                        **self.pending.get(guild_id, {}),
+                    }
+                self.oldest = (
+                    oldest if self.oldest is None else min(oldest, self.oldest)
+                )
+                raise
+            finally:
+                self.flushing = {}
+            metrics.observe("dndbot_write_behind_batch", len(batch))
+            metrics.observe("dndbot_write_behind_lag_seconds", monotonic() - oldest)
+
+    async def run(self) -> None:
+        try:
+            while True:
+                await sleep(self.interval)
+                try:
+                    await self.flush()
+                except Exception as e:
+                    print(f"Write-behind flush failed: {e!r}")
+        except CancelledError:
+            # Shutting down: write out whatever is left
+            await self.flush()
+            raise